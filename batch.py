@@ -0,0 +1,167 @@
+"""
+Simulating many small independent circuits in a few ngspice runs.
+
+When every circuit only takes microseconds to solve, launching ngspice and
+parsing the deck dominate the run time. simulate_batch merges batch_size
+circuits into one deck: each circuit's nodes are shifted past the previous
+one's and its component names get a _b<k> suffix. The deck runs once, and
+the vectors are split back and renamed, so every circuit ends up with its
+own operating_points, current and result, as after a compute_* call.
+
+    simulate_batch(variants, 'ac', 1, 1e9, 10, batch_size=64)
+    variants[3].operating_points[2]
+"""
+
+from main import Circuit, Voltage, ComponentArray, RunStats, VECTOR_NAME, run_spice
+from ngspice_read import spice_plot, spice_vector
+from concurrent.futures import ProcessPoolExecutor
+import bisect
+import re
+
+BATCH_SUFFIX = re.compile(r"_b(\d+)(?=[.]|$)")
+
+
+class BatchResult(object):
+    """ Quacks like ngspice_read, holding one circuit's share of a batched run """
+
+    def __init__(self, plots):
+        self.plots = plots
+
+    def get_plots(self):
+        return self.plots
+
+
+def rename_vector(name, suffix, offset):
+    """ The name a vector of one circuit has in the merged deck """
+    match = VECTOR_NAME.match(name)
+    if match is None:
+        return name
+    kind, node = match.group(1, 2)
+    if node.isdigit():
+        node = str(int(node) + offset) if node != '0' else node
+    else:
+        head, dot, tail = node.partition('.')
+        node = head + suffix + dot + tail
+    return F"{kind}({node})"
+
+
+def merge(circuits):
+    """ One deck body simulating every circuit side by side, and the node offset of each """
+    header = Circuit()
+    definitions = {}
+    offsets = []
+    body = []
+    offset = 0
+    for k, circuit in enumerate(circuits):
+        for imp in circuit.imports:
+            header.import_library(imp, *(circuit.library_names.get(imp) or []))
+        for definition in circuit.subcircuits:
+            definitions.setdefault(definition.name, definition)
+
+        suffix = F"_b{k}"
+        circuit.generate_components()
+        for component, lines in zip(circuit.components, circuit._lines):
+            nodes = 2 if isinstance(component, (Voltage, ComponentArray)) else len(component.ports)
+            for line in lines.split("\n"):
+                tokens = line.split(' ', nodes + 1)
+                tokens[0] += suffix
+                tokens[1:nodes + 1] = [node if node == '0' else str(int(node) + offset)
+                                       for node in tokens[1:nodes + 1]]
+                body.append(' '.join(tokens))
+        offsets.append(offset)
+        offset += circuit.node_count - 1
+
+    # A .save is only safe when every circuit names what it needs
+    if all(circuit.probes for circuit in circuits):
+        saved = [rename_vector(name, F"_b{k}", offsets[k]) for k, circuit in enumerate(circuits)
+                 for name in circuit.probes]
+        body.append(".save " + ' '.join(saved))
+    for k, circuit in enumerate(circuits):
+        if circuit.warm_start and circuit.initial_guess:
+            guesses = ' '.join(F"v({node + offsets[k]})={voltage:.6g}"
+                               for node, voltage in sorted(circuit.initial_guess.items()) if node < circuit.node_count)
+            body.append(F".{circuit.warm_start} {guesses}")
+
+    spice = header.load_imports() + ''.join(d.generate_spice() for d in definitions.values()) + "\n".join(body) + "\n"
+    return spice, offsets
+
+
+def split(raw, circuits, offsets):
+    """ Splits the plots of a merged run into one BatchResult per circuit """
+    plots = [[] for circuit in circuits]
+    for plot in raw.get_plots():
+        scale = plot.get_scalevector()
+        named = scale.name in ('time', 'frequency')
+        vectors = [[] for circuit in circuits]
+        for vec in ([] if named else [scale]) + plot.get_datavectors():
+            match = VECTOR_NAME.match(vec.name)
+            if match is None:
+                continue
+            kind, node = match.group(1, 2)
+            if node.isdigit():
+                if node == '0':
+                    continue
+                k = bisect.bisect_left(offsets, int(node)) - 1
+                node = str(int(node) - offsets[k])
+            else:
+                found = BATCH_SUFFIX.search(node)
+                if found is None:
+                    continue
+                k = int(found.group(1))
+                node = node[:found.start()] + node[found.end():]
+            vectors[k].append(spice_vector(vec.get_data(), name=F"{kind}({node})", type=vec.type))
+
+        for k in range(len(circuits)):
+            own = spice_plot(plotname=plot.plotname, title=plot.title, plottype=plot.plottype)
+            if named:
+                own.set_scalevector(scale)
+                own.set_datavectors(vectors[k])
+            elif vectors[k]:
+                own.set_scalevector(vectors[k][0])
+                own.set_datavectors(vectors[k][1:])
+            else:
+                continue
+            plots[k].append(own)
+    return [BatchResult(circuit_plots) for circuit_plots in plots]
+
+
+def simulate_batch(circuits, analysis='op', *args, batch_size=32, processes=None):
+    """
+    Runs analysis ('op', 'ac' or 'tran' with the arguments of the matching
+    compute_* method) on every circuit, batch_size circuits per ngspice run.
+    Bigger batches mean fewer process launches but bigger raw files. With
+    processes the batches run in parallel. The first circuit's pool and cache
+    are used otherwise.
+    """
+    if analysis not in ('op', 'ac', 'tran'):
+        raise Exception("Only op, ac and tran analyses can be batched", analysis)
+    if not circuits:
+        return
+    first = circuits[0]
+    directive = Circuit.ANALYSES[analysis](first, *args)
+
+    batches = []
+    decks = []
+    for start in range(0, len(circuits), batch_size):
+        batch = circuits[start:start + batch_size]
+        stats = RunStats(analysis)
+        with stats.stage('generate'):
+            body, offsets = merge(batch)
+            decks.append("Operating point simulation\n" + body + directive + "\n.end\n")
+        batches.append((batch, offsets, stats))
+
+    if processes is not None:
+        with ProcessPoolExecutor(processes) as executor:
+            raws = list(executor.map(run_spice, decks))
+    else:
+        raws = [run_spice(deck, pool=first.pool, cache=first.cache, stats=stats)
+                for deck, (batch, offsets, stats) in zip(decks, batches)]
+
+    for raw, (batch, offsets, stats) in zip(raws, batches):
+        with stats.stage('load'):
+            results = split(raw, batch, offsets)
+            for circuit, result in zip(batch, results):
+                circuit._load_result(result, unary=analysis == 'op')
+                circuit._remember_operating_point(analysis, *args)
+        for circuit in batch:
+            circuit._report(stats)
@@ -0,0 +1,261 @@
+"""
+Benchmarks for the Python side of the simulation pipeline.
+
+Generated circuits of growing size (resistor ladders, also built in bulk from
+ResistorArrays, RC meshes and arrays of BFR181 subcircuit instances) are timed stage by stage: construction with
+connect/ground, generate_spice, run_spice, ngspice_read, _load_result and
+render_svg. By default ngspice is replaced by fake_ngspice.py, which replays
+a canned raw file, so the numbers only move when the Python side does.
+
+    python benchmark.py
+    python benchmark.py --sizes 100 1000 10000 --json results.json
+    python benchmark.py --ngspice    # run the real simulator instead
+"""
+
+from main import Circuit, Resistor, Capacitor, Voltage, ResistorArray, connect, ground, import_subcircuit, run_spice
+from ngspice_read import ngspice_read
+import argparse
+import json
+import main
+import math
+import numpy
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def write_raw(path, npoints, nvars, binary=True, complex=False, plots=1, names=None):
+    """
+    Writes a synthetic ngspice raw file with a scale and nvars-1 vectors,
+    named v(1)... unless names are given
+    """
+    scale = 'frequency' if complex else 'time'
+    names = names or [F"v({n})" for n in range(1, nvars)]
+    data = numpy.random.default_rng(0).standard_normal((npoints, nvars * (2 if complex else 1)))
+    with open(path, 'wb') as f:
+        for plot in range(plots):
+            header = "Title: benchmark\nDate: today\n"
+            header += F"Plotname: {'AC Analysis' if complex else 'Transient Analysis'}\n"
+            header += F"Flags: {'complex' if complex else 'real'}\n"
+            header += F"No. Variables: {nvars}\nNo. Points: {npoints}\nVariables:\n"
+            header += F"\t0\t{scale}\t{scale}\n"
+            header += ''.join(F"\t{n + 1}\t{name}\t{'current' if name.startswith('i(') else 'voltage'}\n"
+                              for n, name in enumerate(names))
+            if binary:
+                f.write((header + "Binary:\n").encode())
+                f.write(data.tobytes())
+            else:
+                f.write((header + "Values:\n").encode())
+                rows = []
+                for p in range(npoints):
+                    if complex:
+                        values = [F"{data[p, 2*n]:.15e},{data[p, 2*n+1]:.15e}" for n in range(nvars)]
+                    else:
+                        values = [F"{v:.15e}" for v in data[p]]
+                    rows.append(F"{p}\t" + "\n\t".join(values) + "\n\n")
+                f.write(''.join(rows).encode())
+
+
+def timed(function, repeat=3):
+    best = float('inf')
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def read_all(path, **kwargs):
+    """ Parses path and touches every value so lazy views are paid for too """
+    total = 0.0
+    for plot in ngspice_read(path, **kwargs).get_plots():
+        for vec in [plot.get_scalevector()] + plot.get_datavectors():
+            total += abs(vec.get_data().sum())
+    return total
+
+
+def resistor_ladder(n):
+    c = Circuit()
+    source = Voltage(c, voltage=1)
+    series = [Resistor(c, resistance=10) for i in range(n)]
+    shunt = [Resistor(c, resistance=1e3) for i in range(n)]
+    connect(source.pos, series[0])
+    for i in range(n):
+        if i + 1 < n:
+            connect(series[i], shunt[i], series[i + 1])
+        else:
+            connect(series[i], shunt[i])
+    ground(source.neg, *shunt)
+    return c
+
+
+def resistor_ladder_array(n):
+    """ resistor_ladder built in bulk from ResistorArrays """
+    c = Circuit()
+    source = Voltage(c, voltage=1)
+    nodes = c.new_nodes(n)
+    source.pos.node = nodes[0]
+    source.neg.node = 0
+    ResistorArray(c, nodes[1:], nodes[:-1], 10)
+    ResistorArray(c, nodes, 0, 1e3)
+    return c
+
+
+def rc_mesh(n):
+    """ A square grid of about n nodes, resistors between neighbours and a capacitor to ground each """
+    side = max(2, int(round(math.sqrt(n))))
+    c = Circuit()
+    source = Voltage(c, voltage=1)
+    across = [[Resistor(c, resistance=10) for j in range(side - 1)] for i in range(side)]
+    down = [[Resistor(c, resistance=10) for j in range(side)] for i in range(side - 1)]
+    caps = [[Capacitor(c, capacitance=1e-12) for j in range(side)] for i in range(side)]
+    # Nodes are visited in row-major order, so each connect() picks the right (first free) port
+    for i in range(side):
+        for j in range(side):
+            parts = [source.pos] if i == j == 0 else []
+            if j > 0:
+                parts.append(across[i][j - 1])
+            if j < side - 1:
+                parts.append(across[i][j])
+            if i > 0:
+                parts.append(down[i - 1][j])
+            if i < side - 1:
+                parts.append(down[i][j])
+            parts.append(caps[i][j])
+            connect(*parts)
+    ground(source.neg, *[cap for row in caps for cap in row])
+    return c
+
+
+def bfr181_array(n):
+    c = Circuit()
+    RFTransistor = import_subcircuit(c, os.path.join(HERE, 'BFR181_spice_v2.txt'), 'BFR181',
+                                     'collector', 'base', 'emitter', symbol='npn')
+    supply = Voltage(c, voltage=5)
+    bias = Voltage(c, voltage=0.8)
+    transistors = [RFTransistor(c) for i in range(n)]
+    collectors = [Resistor(c, resistance=1e3) for i in range(n)]
+    bases = [Resistor(c, resistance=1e4) for i in range(n)]
+    for t, rc, rb in zip(transistors, collectors, bases):
+        connect(rc, t.collector)
+        connect(rb, t.base)
+    connect(supply.pos, *collectors)
+    connect(bias.pos, *bases)
+    ground(supply.neg, bias.neg, *[t.emitter for t in transistors])
+    return c
+
+
+CIRCUITS = {
+    'resistor_ladder': resistor_ladder,
+    'resistor_ladder_array': resistor_ladder_array,
+    'rc_mesh': rc_mesh,
+    'bfr181_array': bfr181_array,
+}
+
+
+def canned_raw(path, circuit, npoints):
+    """ A transient raw file with exactly the vectors ngspice would write for circuit """
+    names = [F"v({n})" for n in range(1, circuit.node_count)]
+    names += [F"i({component.name.lower()})" for component in circuit.components if isinstance(component, Voltage)]
+    write_raw(path, npoints, len(names) + 1, names=names)
+
+
+def bench_pipeline(name, size, npoints=1000, repeat=3, real_ngspice=False):
+    builder = CIRCUITS[name]
+    results = {}
+    results['construct'] = timed(lambda: builder(size), repeat)
+    c = builder(size)
+
+    results['generate_spice'] = timed(lambda: c.generate_spice(), repeat)
+    component = c.components[len(c.components) // 2]
+    def regenerate():
+        component.name = component.name # marks the component dirty
+        c.generate_spice()
+    results['regenerate_one'] = timed(regenerate, repeat)
+
+    scratch = tempfile.mkdtemp()
+    try:
+        raw_file = os.path.join(scratch, "canned.raw")
+        canned_raw(raw_file, c, npoints)
+        deck = c._deck(c.tran_directive(npoints * 1e-9, 1e-9))
+        if not real_ngspice:
+            os.environ['FAKE_NGSPICE_RAW'] = raw_file
+        results['run_spice'] = timed(lambda: run_spice(deck), repeat)
+        results['ngspice_read'] = timed(lambda: ngspice_read(raw_file), repeat)
+
+        raw = ngspice_read(raw_file)
+        results['load_result'] = timed(lambda: c._load_result(raw), repeat)
+        def load_and_access():
+            c._load_result(raw)
+            for node in c.operating_points:
+                c.operating_points[node]
+        results['load_result_access_all'] = timed(load_and_access, repeat)
+    finally:
+        shutil.rmtree(scratch)
+
+    if shutil.which('netlistsvg') and size <= 1000:
+        results['render_svg'] = timed(lambda: c.render_svg(), 1)
+
+    return [{'suite': 'pipeline', 'circuit': name, 'size': size, 'components': len(c.components),
+             'nodes': c.node_count, 'stage': stage, 'seconds': seconds}
+            for stage, seconds in results.items()]
+
+
+def bench_raw_read(npoints=20000, nvars=20, repeat=3):
+    records = []
+    scratch = tempfile.mkdtemp()
+    try:
+        for complex in (False, True):
+            kind = 'complex' if complex else 'real'
+            binary = os.path.join(scratch, F"{kind}.bin.raw")
+            ascii = os.path.join(scratch, F"{kind}.ascii.raw")
+            write_raw(binary, npoints, nvars, binary=True, complex=complex)
+            write_raw(ascii, npoints, nvars, binary=False, complex=complex)
+
+            for format, parser, seconds in (
+                    ('binary', 'mmap', timed(lambda: read_all(binary), repeat)),
+                    ('ascii', 'bulk', timed(lambda: read_all(ascii), repeat)),
+                    ('ascii', 'lines', timed(lambda: read_all(ascii, bulk_ascii=False), 1))):
+                records.append({'suite': 'raw_read', 'format': format, 'kind': kind, 'parser': parser,
+                                'points': npoints, 'vectors': nvars, 'seconds': seconds})
+    finally:
+        shutil.rmtree(scratch)
+    return records
+
+
+def describe(record):
+    if record['suite'] == 'pipeline':
+        return F"{record['circuit']}[{record['size']}] {record['stage']}"
+    return F"read {record['format']} {record['kind']} ({record['parser']}, {record['points']}x{record['vectors']})"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--circuits', nargs='+', choices=sorted(CIRCUITS), default=sorted(CIRCUITS))
+    parser.add_argument('--points', type=int, default=1000, help="points in the canned transient raw files")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--ngspice', action='store_true', help="use the real ngspice instead of fake_ngspice.py")
+    parser.add_argument('--json', help="write the results as JSON to this file ('-' for stdout)")
+    args = parser.parse_args()
+
+    if not args.ngspice:
+        main.NGSPICE = [sys.executable, os.path.join(HERE, 'fake_ngspice.py')]
+
+    records = bench_raw_read(repeat=args.repeat)
+    for name in args.circuits:
+        for size in args.sizes:
+            records += bench_pipeline(name, size, args.points, args.repeat, args.ngspice)
+
+    if args.json == '-':
+        json.dump(records, sys.stdout, indent=1)
+    else:
+        for record in records:
+            print(F"{describe(record):60s} {record['seconds'] * 1e3:10.2f} ms")
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(records, f, indent=1)
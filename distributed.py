@@ -0,0 +1,328 @@
+"""
+Parameter sweeps sharded across worker processes on any number of hosts.
+
+A sweep is flattened into a job spec, plain JSON holding the deck pieces
+(imports, subcircuit definitions, component lines, directives) and, for
+every swept parameter, the component line it produces at each grid value.
+Workers rebuild each grid point's deck from that alone, run ngspice and
+stream the raw file back unparsed. The coordinator parses it with
+ngspice_read.from_buffer.
+
+Connections are authenticated with a shared key, random unless one is
+given, and every control message is JSON, so nothing received is ever
+unpickled. Traffic is not encrypted: keep it on a trusted network. Remote
+workers get the key through the TURMERIC_AUTHKEY environment variable (hex),
+never on the command line.
+
+    coordinator = Coordinator(('0.0.0.0', 6000))
+    print(coordinator.authkey.hex())
+    # on every host: TURMERIC_AUTHKEY=<key> python distributed.py worker coordinator-host:6000
+    coordinator.spawn_local_workers(4) # or just use this one
+    result = coordinator.sweep(c, {(r1, 'resistance'): [1e3, 2e3]}, 'tran', 1e-6, 1e-9)
+"""
+
+from main import Circuit, RunStats, SimulationResult, SweepResult, simulate_to_file
+from multiprocessing.connection import Listener, Client, AuthenticationError
+from ngspice_read import ngspice_read, scratch_dir
+import argparse
+import itertools
+import json
+import numpy
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+
+AUTHKEY_VARIABLE = 'TURMERIC_AUTHKEY'
+VERSION = 1
+
+
+def send_message(conn, *fields):
+    conn.send_bytes(json.dumps(fields).encode())
+
+
+def recv_message(conn):
+    """ The next control message as a list, JSON rather than pickle so a peer can't run code here """
+    message = json.loads(conn.recv_bytes())
+    if not isinstance(message, list) or not message or not isinstance(message[0], str):
+        raise EOFError("Malformed message", message)
+    return message
+
+
+def job_spec(circuit, grid, analysis='op', *args):
+    """
+    The JSON-serializable description of circuit.parameter_sweep(grid, analysis, *args).
+    Keys of grid are (component, attribute) like for parameter_sweep.
+    """
+    params = list(grid.keys())
+    # numpy scalars (from numpy.arange and friends) aren't JSON serializable
+    values = [[value.item() if isinstance(value, numpy.generic) else value for value in grid[param]]
+              for param in params]
+    components = [component for component, attribute in params]
+    if len(set(components)) != len(components):
+        raise Exception("Only one attribute per component can be swept in a job")
+
+    lines = []
+    for (component, attribute), param_values in zip(params, values):
+        original = getattr(component, attribute)
+        try:
+            variants = []
+            for value in param_values:
+                setattr(component, attribute, value)
+                variants.append(component.generate_spice())
+        finally:
+            setattr(component, attribute, original)
+        lines.append({'component': component._index, 'lines': variants})
+
+    circuit.generate_components()
+    return {
+        'version': VERSION,
+        'analysis': analysis,
+        'header': "Operating point simulation\n" + circuit.load_imports() + circuit.load_subcircuits(),
+        'lines': list(circuit._lines),
+        'footer': circuit.save_directive() + circuit.warm_start_directive(),
+        'directives': [Circuit.ANALYSES[analysis](circuit, *args)],
+        'params': [F"{component.name}.{attribute}" for component, attribute in params],
+        'values': values,
+        'variants': lines,
+    }
+
+
+def job_shape(spec):
+    return tuple(len(values) for values in spec['values'])
+
+
+def job_deck(spec, index):
+    """ The deck of grid point index (counted in itertools.product order) """
+    point = numpy.unravel_index(index, job_shape(spec)) if spec['values'] else ()
+    lines = list(spec['lines'])
+    for variant, i in zip(spec['variants'], point):
+        lines[variant['component']] = variant['lines'][i]
+    body = "\n".join(lines) + "\n" if lines else ""
+    return spec['header'] + body + spec['footer'] + "".join(d + "\n" for d in spec['directives']) + ".end\n"
+
+
+def simulate_raw(spice):
+    """ Runs the deck and returns the raw file's bytes """
+    fd, raw_file = tempfile.mkstemp(suffix=".raw", dir=scratch_dir())
+    os.close(fd)
+    try:
+        simulate_to_file(spice, raw_file, RunStats())
+        with open(raw_file, 'rb') as f:
+            return f.read()
+    finally:
+        os.remove(raw_file)
+
+
+def worker(address, authkey):
+    """
+    Connects to a Coordinator and simulates whatever it hands out until it
+    says quit or goes away. Results go back as ['result', index] followed by
+    the raw file as one binary message.
+    """
+    conn = Client(address, authkey=authkey)
+    specs = {}
+    try:
+        while True:
+            try:
+                message = recv_message(conn)
+            except (EOFError, ValueError):
+                return
+            if message[0] == 'quit':
+                return
+            elif message[0] == 'job':
+                _, job_id, spec = message
+                specs[job_id] = json.loads(spec)
+            elif message[0] == 'run':
+                _, job_id, indices = message
+                for index in indices:
+                    try:
+                        raw = simulate_raw(job_deck(specs[job_id], index))
+                    except Exception as e:
+                        send_message(conn, 'error', index, repr(e))
+                        continue
+                    send_message(conn, 'result', index)
+                    conn.send_bytes(raw)
+    finally:
+        conn.close()
+
+
+class Job(object):
+    """ Bookkeeping for one sweep on the coordinator """
+    IDS = itertools.count()
+
+    def __init__(self, spec, retries):
+        self.id = next(Job.IDS)
+        self.spec = json.dumps(spec)
+        self.count = int(numpy.prod(job_shape(spec)))
+        self.retries = retries
+        self.results = {}
+        self.attempts = {}
+        self.error = None
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+
+    def done(self, index, raw):
+        with self.lock:
+            self.results[index] = raw
+            if len(self.results) == self.count:
+                self.finished.set()
+
+    def fail(self, error):
+        with self.lock:
+            self.error = self.error or error
+        self.finished.set()
+
+    def lost(self, indices, tasks):
+        """ Requeues the indices a lost worker had not finished, returns False when out of retries """
+        with self.lock:
+            missing = [index for index in indices if index not in self.results]
+            for index in missing:
+                self.attempts[index] = self.attempts.get(index, 0) + 1
+                if self.attempts[index] > self.retries:
+                    self.error = self.error or Exception("Gave up on grid point after losing workers", index)
+                    self.finished.set()
+                    return False
+        if missing:
+            tasks.put((self, missing))
+        return True
+
+
+class Coordinator(object):
+    """
+    Hands out chunks of grid points to every connected worker. A chunk whose
+    worker disconnects is requeued (up to retries times per point) for the
+    remaining workers. Workers must present authkey, 32 random bytes by default.
+    """
+
+    def __init__(self, address=('127.0.0.1', 0), authkey=None, retries=2):
+        authkey = authkey or os.urandom(32)
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        self.authkey = authkey
+        self.retries = retries
+        self.tasks = queue.Queue()
+        self.connections = []
+        self.jobs = set() # Jobs still running
+        self.processes = []
+        self.lock = threading.Lock()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except AuthenticationError:
+                continue
+            except OSError:
+                return # closed
+            with self.lock:
+                self.connections.append(conn)
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        known = set()
+        try:
+            while True:
+                task = self.tasks.get()
+                if task is None:
+                    send_message(conn, 'quit')
+                    return
+                job, indices = task
+                if job.finished.is_set():
+                    continue
+                try:
+                    if job.id not in known:
+                        send_message(conn, 'job', job.id, job.spec)
+                        known.add(job.id)
+                    send_message(conn, 'run', job.id, indices)
+                    for i in range(len(indices)):
+                        message = recv_message(conn)
+                        if message[0] == 'result' and message[1:] and message[1] in indices:
+                            job.done(message[1], conn.recv_bytes())
+                        elif message[0] == 'error' and len(message) == 3:
+                            job.fail(Exception("Simulation failed on worker for grid point", message[1], message[2]))
+                        else:
+                            raise EOFError("Unexpected message from worker", message[0])
+                except (EOFError, OSError, ValueError):
+                    job.lost(indices, self.tasks)
+                    return
+        finally:
+            with self.lock:
+                if conn in self.connections:
+                    self.connections.remove(conn)
+                stranded = list(self.jobs) if not self.connections else []
+            conn.close()
+            # Requeued points would wait forever with nobody left to pick them up
+            for job in stranded:
+                job.fail(Exception("Every worker disconnected before the sweep finished"))
+
+    def workers(self):
+        with self.lock:
+            return len(self.connections)
+
+    def run(self, spec, chunksize=None, timeout=None):
+        """ Simulates every grid point of spec and returns the parsed results in grid order """
+        job = Job(spec, self.retries)
+        chunksize = chunksize or max(1, job.count // (4 * max(1, self.workers())))
+        with self.lock:
+            self.jobs.add(job)
+        try:
+            for start in range(0, job.count, chunksize):
+                self.tasks.put((job, list(range(start, min(start + chunksize, job.count)))))
+            if not job.finished.wait(timeout):
+                job.fail(Exception("Sweep did not finish within", timeout))
+        finally:
+            with self.lock:
+                self.jobs.discard(job)
+        if job.error is not None:
+            raise job.error
+        return [ngspice_read.from_buffer(job.results[index]) for index in range(job.count)]
+
+    def sweep(self, circuit, grid, analysis='op', *args, chunksize=None, timeout=None):
+        """ Circuit.parameter_sweep, simulated by the workers """
+        spec = job_spec(circuit, grid, analysis, *args)
+        results = self.run(spec, chunksize=chunksize, timeout=timeout)
+        return SweepResult(list(grid.keys()), spec['values'],
+                           [SimulationResult(result, unary=analysis == 'op').plot(0) for result in results])
+
+    def spawn_local_workers(self, count):
+        """ Starts count worker processes on this machine """
+        host, port = self.address
+        # The key goes through the environment, the command line is visible to ps
+        env = dict(os.environ, **{AUTHKEY_VARIABLE: self.authkey.hex()})
+        for i in range(count):
+            self.processes.append(subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), 'worker', F"{host}:{port}"], env=env))
+
+    def close(self):
+        with self.lock:
+            count = len(self.connections)
+        for i in range(count):
+            self.tasks.put(None)
+        self.listener.close()
+        for process in self.processes:
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulation worker for distributed.Coordinator")
+    parser.add_argument('mode', choices=['worker'])
+    parser.add_argument('address', help="host:port of the coordinator")
+    args = parser.parse_args()
+    if not os.environ.get(AUTHKEY_VARIABLE):
+        parser.error(F"the coordinator's key (Coordinator.authkey.hex()) must be in ${AUTHKEY_VARIABLE}")
+    host, port = args.address.rsplit(':', 1)
+    worker((host, int(port)), authkey=bytes.fromhex(os.environ[AUTHKEY_VARIABLE]))
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+"""
+Stand-in for ngspice that replays a canned raw file instead of simulating.
+
+It accepts the command lines run_spice uses, reads the deck from stdin and
+copies the raw file named by $FAKE_NGSPICE_RAW to the -r path (or to every
+path a .control block writes to), so the Python side of the pipeline can be
+timed without depending on simulator speed.
+"""
+
+import os
+import re
+import shutil
+import sys
+
+
+def main(argv):
+    deck = sys.stdin.read()
+    targets = []
+    for i, arg in enumerate(argv):
+        if arg.startswith('-r'):
+            targets.append(arg[2:] or argv[i + 1])
+    if not targets:
+        targets = re.findall(r"^\s*write\s+(\S+)", deck, re.M | re.I)
+    for target in targets:
+        shutil.copyfile(os.environ['FAKE_NGSPICE_RAW'], target)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,15 +1,206 @@
 from subprocess import Popen, PIPE, call
-from ngspice_read import ngspice_read
+from ngspice_read import ngspice_read, scratch_dir, RAW_FILE
+from modellib import load_library
 import tempfile
 import os
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import itertools
+import numpy
 import re
 import json
+import asyncio
+import sys
+import time
+import weakref
+from contextlib import contextmanager
 
-def run_spice(spice):
+# Command used to launch ngspice, benchmarks swap in fake_ngspice.py here
+NGSPICE = ['ngspice']
+
+class RunStats(object):
+    """
+    Where the time of one simulation went: wall and CPU seconds per stage
+    (generate, spawn, simulate, parse, load), the size of what moved between
+    the stages and the resource usage of the ngspice child.
+    """
+
+    def __init__(self, analysis=None, engine='ngspice'):
+        self.analysis = analysis
+        self.engine = engine
+        self.stages = {} # name -> {'wall': seconds, 'cpu': seconds}
+        self.deck_bytes = None
+        self.raw_bytes = None
+        self.plots = self.points = self.vectors = self.values = None
+        self.cache_hit = None # None when no cache is configured
+        self.peak_rss = None # Bytes, ngspice child only
+        self.rusage = None # Child's resource.struct_rusage as a dict
+
+    @contextmanager
+    def stage(self, name):
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield self
+        finally:
+            totals = self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0})
+            totals['wall'] += time.perf_counter() - wall
+            totals['cpu'] += time.process_time() - cpu
+
+    def record_child(self, rusage):
+        self.rusage = {field: getattr(rusage, field) for field in dir(rusage) if field.startswith('ru_')}
+        # ru_maxrss is in kilobytes on Linux but bytes on macOS
+        self.peak_rss = rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+    def record_result(self, result):
+        sizes = [(len(plot.get_scalevector().get_data()), 1 + len(plot.get_datavectors()))
+                 for plot in result.get_plots()]
+        self.plots = len(sizes)
+        self.points = sum(points for points, _ in sizes)
+        self.vectors = max((vectors for _, vectors in sizes), default=0)
+        self.values = sum(points * vectors for points, vectors in sizes)
+
+    @property
+    def wall(self):
+        return sum(stage['wall'] for stage in self.stages.values())
+
+    def as_dict(self):
+        return dict(self.__dict__, wall=self.wall)
+
+    def __repr__(self):
+        stages = ', '.join(F"{name}={stage['wall'] * 1e3:.2f}ms" for name, stage in self.stages.items())
+        return F"RunStats({self.analysis}, {self.engine}: {stages})"
+
+def run_spice(spice, pool=None, cache=None, stats=None):
+    """ Simulates the deck spice, filling in stats (a RunStats) along the way if given """
     #print(spice)
-    raw_file = os.path.join(tempfile.mkdtemp(), "spice.raw")
-    Popen(['ngspice', '-a', '-b', '-r' + raw_file], stdin=PIPE, stdout=PIPE).communicate(input=spice.encode())
-    return ngspice_read(raw_file)
+    if stats is not None:
+        stats.deck_bytes = len(spice.encode())
+    if cache is not None:
+        if stats is not None:
+            stats.cache_hit = True # until the cache has to simulate
+        result = cache.run(spice, lambda spice: run_spice(spice, pool=pool, stats=stats))
+        if stats is not None and stats.cache_hit:
+            stats.record_result(result)
+        return result
+    if stats is None:
+        stats = RunStats()
+    elif stats.cache_hit:
+        stats.cache_hit = False
+    if pool is not None:
+        with stats.stage('simulate'):
+            result = pool.run(spice)
+        stats.record_result(result)
+        return result
+    # The raw file lives on tmpfs when possible and is unlinked as soon as it is
+    # mapped, the parsed vectors keep the mapping (and so the data) alive.
+    fd, raw_file = tempfile.mkstemp(suffix=".raw", dir=scratch_dir())
+    os.close(fd)
+    try:
+        simulate_to_file(spice, raw_file, stats)
+        with stats.stage('parse'):
+            result = ngspice_read(raw_file)
+        stats.record_result(result)
+        return result
+    finally:
+        os.remove(raw_file)
+
+def ngspice_command(spice, raw_file):
+    """ The ngspice command line writing the deck spice's results to raw_file, and the deck to feed it """
+    if RAW_FILE in spice:
+        # The deck's .control block writes the raw file itself
+        return NGSPICE + ['-b'], spice.replace(RAW_FILE, raw_file)
+    return NGSPICE + ['-a', '-b', '-r' + raw_file], spice
+
+def simulate_to_file(spice, raw_file, stats):
+    """ Runs ngspice on the deck spice, leaving its raw output in raw_file """
+    command, spice = ngspice_command(spice, raw_file)
+    if not hasattr(os, 'wait4'):
+        # Without wait4 (Windows) there is no resource usage to collect
+        with stats.stage('spawn'):
+            process = Popen(command, stdin=PIPE, stdout=PIPE)
+        with stats.stage('simulate'):
+            log, _ = process.communicate(spice.encode())
+    else:
+        # The deck goes in through a file rather than a pipe so the child can be
+        # reaped with wait4, which also hands back its resource usage.
+        with tempfile.TemporaryFile(dir=scratch_dir()) as deck:
+            deck.write(spice.encode())
+            deck.seek(0)
+            with stats.stage('spawn'):
+                process = Popen(command, stdin=deck, stdout=PIPE)
+            with stats.stage('simulate'):
+                log = process.stdout.read()
+                process.stdout.close()
+                _, status, rusage = os.wait4(process.pid, 0)
+                process.returncode = os.waitstatus_to_exitcode(status)
+        stats.record_child(rusage)
+    stats.raw_bytes = os.path.getsize(raw_file)
+    if stats.raw_bytes == 0:
+        raise Exception("ngspice produced no raw output", log.decode(errors='replace'))
+
+# Cap on ngspice processes started by run_spice_async, one semaphore per
+# event loop since asyncio primitives can't be shared between loops
+ASYNC_LIMIT = os.cpu_count() or 1
+ASYNC_LIMITS = weakref.WeakKeyDictionary()
+
+def async_limit():
+    """ The default semaphore of run_spice_async for the running event loop """
+    loop = asyncio.get_running_loop()
+    limit = ASYNC_LIMITS.get(loop)
+    if limit is None:
+        limit = ASYNC_LIMITS[loop] = asyncio.Semaphore(ASYNC_LIMIT)
+    return limit
+
+async def run_spice_async(spice, pool=None, cache=None, stats=None, limit=None, executor=None):
+    """
+    Coroutine version of run_spice built on an asyncio subprocess. At most
+    limit (an asyncio.Semaphore, async_limit() by default) simulations run at
+    once, parsing happens on executor and cancelling kills ngspice.
+    """
+    loop = asyncio.get_running_loop()
+    if stats is None:
+        stats = RunStats()
+    stats.deck_bytes = len(spice.encode())
+    if cache is not None:
+        # The cache reads and writes pickles on disk, which must not block the loop
+        result = await loop.run_in_executor(executor, cache.get, spice)
+        stats.cache_hit = result is not None
+        if result is None:
+            result = await run_spice_async(spice, pool=pool, stats=stats, limit=limit, executor=executor)
+            await loop.run_in_executor(executor, cache.put, spice, result)
+        stats.record_result(result)
+        return result
+    if pool is not None:
+        with stats.stage('simulate'):
+            result = await loop.run_in_executor(executor, pool.run, spice)
+        stats.record_result(result)
+        return result
+
+    fd, raw_file = tempfile.mkstemp(suffix=".raw", dir=scratch_dir())
+    os.close(fd)
+    command, spice = ngspice_command(spice, raw_file)
+    try:
+        async with async_limit() if limit is None else limit:
+            with stats.stage('spawn'):
+                process = await asyncio.create_subprocess_exec(*command, stdin=asyncio.subprocess.PIPE,
+                                                               stdout=asyncio.subprocess.PIPE)
+            try:
+                with stats.stage('simulate'):
+                    log, _ = await process.communicate(spice.encode())
+            except BaseException:
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+                raise
+        stats.raw_bytes = os.path.getsize(raw_file)
+        if stats.raw_bytes == 0:
+            raise Exception("ngspice produced no raw output", log.decode(errors='replace'))
+        with stats.stage('parse'):
+            result = await loop.run_in_executor(executor, ngspice_read, raw_file)
+        stats.record_result(result)
+        return result
+    finally:
+        os.remove(raw_file)
 
 def connect(*args):
     node = None 
@@ -53,39 +244,173 @@ def ground(*args):
                     break
 
 class Port(object):
+    # Big circuits hold one Port per terminal, slots keep them small
+    __slots__ = ('circuit', 'component', 'node', 'name')
+
     def __init__(self, circuit, component=None, node=None, name=None):
-        self.circuit = circuit
-        self.node = node
-        self.component = component
-        self.name = name
+        # A new port's component was just added and is dirty already
+        object.__setattr__(self, 'circuit', circuit)
+        object.__setattr__(self, 'component', component)
+        object.__setattr__(self, 'node', node)
+        object.__setattr__(self, 'name', name)
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name == 'node' and self.component is not None:
+            self.component._mark_dirty()
 
     @property
     def voltage(self):
         return self.circuit.operating_points[self.node]
 
+    def probe(self):
+        """ Declares this port an output, see Circuit.probe. Returns the port for chaining """
+        self.circuit.probe(self)
+        return self
+
 class Component(object):
     def __init__(self, prefix=None, name=None):
         pass
 
+    def alter(self, attribute, value):
+        """ ngspice control language line setting attribute to value on the parsed circuit """
+        raise Exception("Can't alter", self.name, attribute)
+
+    def cells(self):
+        """ netlistsvg cells drawing this component """
+        return {self.name: self.json()}
+
+    # Every public attribute (value, name, ...) ends up in the SPICE line, so
+    # setting any of them invalidates the line the circuit has cached. Note that
+    # mutating a value in place (e.g. a piecewise list) is not noticed.
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if not name.startswith('_'):
+            self._mark_dirty()
+
+    def _mark_dirty(self):
+        index = self.__dict__.get('_index')
+        if index is not None:
+            self.circuit._dirty.add(index)
+
+# Contents of imported model files, keyed by path and checked against mtime
+IMPORT_CACHE = {}
+
 class Circuit(object):
-    def __init__(self):
+    """
+    A netlist of components joined by numbered nodes (0 is ground).
+
+    warm_start seeds every deck with the node voltages of the last .op, or of
+    the first point of the last transient that started at t = 0:
+    'nodeset' only hands them to ngspice as a first guess, which speeds up
+    convergence and can't change the solution. 'ic' forces them as the
+    initial conditions of transients instead, so a transient then starts
+    from the remembered state (even if a parameter has changed since) rather
+    than from its own operating point, and its result changes accordingly.
+    """
+
+    def __init__(self, pool=None, cache=None, engine='ngspice', stats_hook=None, warm_start=None):
         self.node_count = 1 # 0 is allocated to GND
         self.components = []
+        self._lines = [] # Cached SPICE line of every component
+        self._dirty = set() # Indices of components whose line is stale
+        self._body = ""
         self.operating_points = {}
         self.current = {}
+        self.result = None # SimulationResult of the last run, with every plot
         self.imports = []
+        self.library_names = {} # Entries needed from each import, None (or missing) inlines the whole file
+        self.subcircuits = [] # SubcircuitDefinitions emitted ahead of the components
+        self.probes = {} # Vectors to .save, in order, everything is saved when empty
+        self.pool = pool # Optional spice_pool.SpicePool shared between runs
+        self.cache = cache # Optional spice_cache.SimulationCache
+        self.engine = engine # 'ngspice', 'native' (see mna.py) or 'auto' to prefer native
+        self.last_run_stats = None # RunStats of the last simulation
+        self.stats_hook = stats_hook # Called with every RunStats, e.g. to ship it to a metrics system
+        self.warm_start = warm_start # None, 'nodeset' or 'ic': seed the next deck with the last operating point
+        self.initial_guess = {} # Node -> voltage of the last operating point, when warm starting
 
     def add(self, component):
+        component._index = len(self.components)
         self.components.append(component)
+        self._lines.append(None)
+        self._dirty.add(component._index)
+
+    def new_nodes(self, count):
+        """ Allocates count fresh nodes at once, for wiring up ResistorArray and friends """
+        nodes = numpy.arange(self.node_count, self.node_count + count)
+        self.node_count += count
+        return nodes
 
     def generate_spice(self):
-        spice = self.load_imports()
-        for component in self.components:
-            spice += component.generate_spice() + "\n"
-        return spice
+        return (self.load_imports() + self.load_subcircuits() + self.generate_components() +
+                self.save_directive() + self.warm_start_directive())
+
+    def probe(self, *targets):
+        """
+        Restricts what ngspice writes to the raw file to the probed vectors:
+        voltages of Ports (or node numbers, or subcircuit node keys from
+        Instance.node) and currents through Voltage sources. Reading anything
+        else after a run raises a KeyError.
+        """
+        for target in targets:
+            if isinstance(target, Port):
+                target = target.node
+            if isinstance(target, Voltage):
+                self.probes[F"i({target.name.lower()})"] = target
+            elif target is None or target == 0:
+                raise Exception("Can't probe an unconnected or ground node", target)
+            else:
+                self.probes[F"v({target})"] = target
+
+    def clear_probes(self):
+        self.probes = {}
+
+    def warm_start_directive(self):
+        """
+        .nodeset (a first guess for every DC solution) or .ic (initial
+        conditions for transients) from the last operating point. Values are
+        rounded so that the deck, and so its cache key, settles too.
+        """
+        if not self.warm_start or not self.initial_guess:
+            return ""
+        guesses = ' '.join(F"v({node})={voltage:.6g}" for node, voltage in sorted(self.initial_guess.items())
+                           if node < self.node_count)
+        return F".{self.warm_start} {guesses}\n"
+
+    def _remember_operating_point(self, analysis, *args):
+        """ Keeps the node voltages of an .op, or of a transient's first point, for warm_start_directive """
+        if not self.warm_start or analysis not in ('op', 'tran'):
+            return
+        if analysis == 'tran' and len(args) > 2 and args[2]:
+            return # The first point is at start, not at the operating point
+        guess = {}
+        for node, voltage in self.operating_points.items():
+            if isinstance(node, int):
+                guess[node] = float(voltage if analysis == 'op' else voltage[0])
+        self.initial_guess = guess
+
+    def save_directive(self):
+        if not self.probes:
+            return ""
+        return ".save " + ' '.join(self.probes) + "\n"
+
+    def generate_components(self):
+        """ The component lines alone, without imports or subcircuit definitions """
+        if self._dirty:
+            for index in self._dirty:
+                self._lines[index] = self.components[index].generate_spice()
+            self._dirty.clear()
+            self._body = "\n".join(self._lines) + "\n" if self._lines else ""
+        return self._body
+
+    def load_subcircuits(self):
+        return ''.join(definition.generate_spice() for definition in self.subcircuits)
 
     def render_svg(self):
-        cells = { component.name: component.json() for component in self.components }
+        cells = {}
+        for component in self.components:
+            cells.update(component.cells())
         cells['gnd'] = {
             'type': 'gnd',
             'port_directions': {
@@ -99,100 +424,506 @@ class Circuit(object):
             'circuit': {
                 'cells': cells }}}
 
-        scratch_dir = tempfile.mkdtemp()
-        netlist_path = os.path.join(scratch_dir, "netlist.json")
-        circuit = os.path.join(scratch_dir, "circuit.svg")
-        with open(netlist_path,'w') as f:
-            f.write(json.dumps(netlist))
-        call(['netlistsvg', netlist_path, '--skin', 'analog.svg', '-o', circuit])
-        with open(circuit,'r') as f:
-            return f.read()
+        with tempfile.TemporaryDirectory(dir=scratch_dir()) as scratch:
+            netlist_path = os.path.join(scratch, "netlist.json")
+            circuit = os.path.join(scratch, "circuit.svg")
+            with open(netlist_path,'w') as f:
+                f.write(json.dumps(netlist))
+            call(['netlistsvg', netlist_path, '--skin', 'analog.svg', '-o', circuit])
+            with open(circuit,'r') as f:
+                return f.read()
         
+    def import_library(self, file, *names):
+        """
+        Makes the definitions in a SPICE library file available to the deck.
+        Given names, only those .SUBCKT/.MODEL entries and whatever they
+        reference are emitted (see modellib), otherwise the whole file is.
+        """
+        if file not in self.imports:
+            self.imports.append(file)
+            self.library_names[file] = list(dict.fromkeys(names)) if names else None
+        elif not names:
+            self.library_names[file] = None
+        elif self.library_names.get(file) is not None:
+            wanted = self.library_names[file]
+            wanted.extend(name for name in names if name not in wanted)
+
     def load_imports(self):
-        # TODO: unique this
-        source = ""
-        for imp in self.imports:
-            with open(imp, 'r') as f:
-                source += f.read() + "\n"
-        return source
+        sources = []
+        for imp in dict.fromkeys(self.imports):
+            names = self.library_names.get(imp)
+            if names:
+                sources.append(load_library(imp).emit(names))
+                continue
+            mtime = os.stat(imp).st_mtime_ns
+            cached = IMPORT_CACHE.get(imp)
+            if cached is None or cached[0] != mtime:
+                with open(imp, 'r') as f:
+                    cached = IMPORT_CACHE[imp] = (mtime, f.read() + "\n")
+            sources.append(cached[1])
+        return ''.join(sources)
 
     def compute_operating_point(self):
-        spice = "Operating point simulation\n"
-        spice += self.generate_spice()
-        spice += ".op\n"
-        spice += ".end\n"
-        result = run_spice(spice)
-
-        self._load_result(result, unary=True)
+        self._run('op', unary=True)
 
     def compute_dc_sweep(self, *sweeps):
         """ Syntax is compute_dc_sweep((Component, start, stop, step),...) """
+        self._run('dc', *sweeps)
+        
+    def compute_ac_sweep(self, start, stop, points, linear=False):
+        self._run('ac', start, stop, points, linear)
+
+    def compute_transient(self, stop, step, start=None, max_step=None, interp=False, decimate=None):
+        """
+        Only timepoints from start on are written out, max_step caps the
+        simulator's internal step and interp resamples the output onto a
+        uniform grid of step (e.g. for FFTs). decimate=n keeps every n-th
+        point while loading, as a view on the raw data.
+        """
+        self._run('tran', stop, step, start, max_step, interp, decimate=decimate)
+
+    # Coroutine versions of the above, for running many circuits from one event loop
+    async def compute_operating_point_async(self):
+        await self._run_async('op', unary=True)
+
+    async def compute_dc_sweep_async(self, *sweeps):
+        await self._run_async('dc', *sweeps)
 
+    async def compute_ac_sweep_async(self, start, stop, points, linear=False):
+        await self._run_async('ac', start, stop, points, linear)
+
+    async def compute_transient_async(self, stop, step, start=None, max_step=None, interp=False, decimate=None):
+        await self._run_async('tran', stop, step, start, max_step, interp, decimate=decimate)
+
+    def op_directive(self):
+        return ".op"
+
+    def dc_directive(self, *sweeps):
         formatted = ' '.join(F"{component.name} {start} {stop} {step}" for component, start, stop, step in sweeps)
-        spice = "Operating point simulation\n"
-        spice += self.generate_spice()
-        spice += F".dc {formatted}\n"
-        spice += ".end\n"
-        result = run_spice(spice)
+        return F".dc {formatted}"
 
-        self._load_result(result)
-        
-    def compute_ac_sweep(self, start, stop, points, linear=False):
-        spice = "Operating point simulation\n"
-        spice += self.generate_spice()
-        spice += F".ac {'LIN' if linear else 'DEC'} {points} {start} {stop}\n"
-        spice += ".end\n"
-        result = run_spice(spice)
+    def ac_directive(self, start, stop, points, linear=False):
+        return F".ac {'LIN' if linear else 'DEC'} {points} {start} {stop}"
+
+    def tran_directive(self, stop, step, start=None, max_step=None, interp=False):
+        directive = F".tran {step}s {stop}s"
+        if start is not None or max_step is not None:
+            directive += F" {start or 0}s"
+        if max_step is not None:
+            directive += F" {max_step}s"
+        if interp:
+            directive = ".options interp\n" + directive
+        return directive
+
+    ANALYSES = {
+        'op': op_directive,
+        'dc': dc_directive,
+        'ac': ac_directive,
+        'tran': tran_directive,
+    }
+
+    # Start of the plotname ngspice gives each analysis in the raw file
+    PLOTNAMES = {
+        'op': 'operating point',
+        'dc': 'dc transfer characteristic',
+        'ac': 'ac analysis',
+        'tran': 'transient analysis',
+    }
+
+    def run_analyses(self, analyses):
+        """
+        Runs several analyses in a single ngspice invocation, e.g.
+        run_analyses(['op', ('dc', (v, 0, 1, 0.1)), ('ac', 1, 1e8, 10), ('tran', 1e-6, 1e-9)])
+        where every entry is an analysis name followed by the arguments of the
+        matching compute_* method. Returns {name: PlotResult}.
+        """
+        specs = [(analysis,) if isinstance(analysis, str) else tuple(analysis) for analysis in analyses]
+        kinds = [spec[0] for spec in specs]
+        if len(set(kinds)) != len(kinds):
+            raise Exception("Each analysis can only be run once per deck", kinds)
+
+        stats = RunStats('+'.join(kinds), self.engine)
+        raw = None
+        if self.engine != 'ngspice':
+            import mna
+            plots = []
+            for kind, *args in specs:
+                result = self._native(kind, args, stats)
+                if result is None:
+                    break
+                plots += result.get_plots()
+            else:
+                raw = mna.NativeResult(plots)
+                stats.record_result(raw)
+        if raw is None:
+            with stats.stage('generate'):
+                spice = self._deck(*[Circuit.ANALYSES[kind](self, *args) for kind, *args in specs])
+            raw = self._simulate(spice, stats)
 
-        self._load_result(result)
+        with stats.stage('load'):
+            self.result = SimulationResult(raw)
+            results = {}
+            for plot in raw.get_plots():
+                for kind in kinds:
+                    if plot.plotname.lower().startswith(Circuit.PLOTNAMES[kind]):
+                        results[kind] = PlotResult(plot, unary=kind == 'op')
+        self._report(stats)
+        missing = [kind for kind in kinds if kind not in results]
+        if missing:
+            raise Exception("ngspice did not return results for", missing)
+        return results
 
-    def compute_transient(self, stop, step):
+    def _deck(self, *directives):
         spice = "Operating point simulation\n"
         spice += self.generate_spice()
-        spice += F".tran {step}s {stop}s\n"
+        for directive in directives:
+            spice += directive + "\n"
         spice += ".end\n"
-        result = run_spice(spice)
+        return spice
+
+    def parameter_sweep(self, grid, analysis='op', *args, processes=None):
+        """
+        Runs analysis ('op', 'dc', 'ac' or 'tran' with the arguments of the matching
+        compute_* method) for every point of grid = {(component, attribute): values, ...}.
+        The variants are simulated in parallel on a process pool and returned as a
+        SweepResult whose arrays are indexed [value index per parameter..., data].
+        With warm_start every variant starts from the circuit's last operating
+        point, which is usually close to that of a nearby design point.
+        """
+        params = list(grid.keys())
+        values = [list(grid[param]) for param in params]
+        stats = RunStats(analysis, self.engine)
+        results = self._native_sweep(params, values, analysis, args, stats)
+        if results is None:
+            results = self._spice_sweep(params, values, analysis, args, stats, processes)
+
+        with stats.stage('load'):
+            sweep = SweepResult(params, values,
+                                [SimulationResult(result, unary=analysis == 'op').plot(0) for result in results])
+        self._report(stats)
+        return sweep
+
+    def _native_sweep(self, params, values, analysis, args, stats):
+        """ Every grid point's result from the native engine, or None when the sweep should go to ngspice """
+        if self.engine == 'ngspice':
+            return None
+        import mna
+        originals = [getattr(component, attribute) for component, attribute in params]
+        results = []
+        try:
+            with stats.stage('simulate'):
+                for point in itertools.product(*values):
+                    for (component, attribute), value in zip(params, point):
+                        setattr(component, attribute, value)
+                    results.append(mna.simulate(self, analysis, *args))
+        except mna.UnsupportedCircuit:
+            if self.engine == 'native':
+                raise
+            stats.stages['native'] = stats.stages.pop('simulate')
+            stats.engine = 'ngspice'
+            return None
+        finally:
+            for (component, attribute), value in zip(params, originals):
+                setattr(component, attribute, value)
+        stats.engine = 'native'
+        return results
+
+    def _spice_sweep(self, params, values, analysis, args, stats, processes=None):
+        """ Every grid point's result from ngspice, one deck per point """
+        originals = [getattr(component, attribute) for component, attribute in params]
+        decks = []
+        with stats.stage('generate'):
+            directive = Circuit.ANALYSES[analysis](self, *args)
+            try:
+                for point in itertools.product(*values):
+                    for (component, attribute), value in zip(params, point):
+                        setattr(component, attribute, value)
+                    decks.append(self._deck(directive))
+            finally:
+                for (component, attribute), value in zip(params, originals):
+                    setattr(component, attribute, value)
+        stats.deck_bytes = sum(len(deck.encode()) for deck in decks)
+
+        results = [None] * len(decks)
+        if self.cache is not None:
+            results = [self.cache.get(deck) for deck in decks]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if self.cache is not None:
+            stats.cache_hit = not missing
+        # Per-process figures are not collected across the executor, only the stage totals
+        with stats.stage('simulate'):
+            if self.pool is not None:
+                # The pool already runs its workers in parallel, it only needs enough threads to feed them
+                with ThreadPoolExecutor(self.pool.size) as executor:
+                    fresh = list(executor.map(self.pool.run, [decks[i] for i in missing]))
+            else:
+                processes = processes or os.cpu_count()
+                with ProcessPoolExecutor(processes) as executor:
+                    chunksize = max(1, len(missing) // (4 * processes))
+                    fresh = list(executor.map(run_spice, [decks[i] for i in missing], chunksize=chunksize))
+        for i, result in zip(missing, fresh):
+            results[i] = result
+            if self.cache is not None:
+                self.cache.put(decks[i], result)
+        return results
+
+    def control_sweep(self, grid, analysis='op', *args):
+        """
+        Like parameter_sweep, but the deck is parsed once and ngspice loops over
+        the grid itself with foreach/alter in a .control block, writing one plot
+        per point into a single raw file. Keys of grid are (component, attribute)
+        or a raw ngspice parameter such as '@r.x0.rb[resistance]'.
+        """
+        params = list(grid.keys())
+        values = [list(grid[param]) for param in params]
+        stats = RunStats(analysis, self.engine)
+        raw_params = [param for param in params if isinstance(param, str)]
+        if raw_params and self.engine == 'native':
+            raise Exception("The native engine can't alter raw ngspice parameters", raw_params)
+        # The native engine solves every point itself, there is nothing to loop over inside ngspice
+        results = None if raw_params else self._native_sweep(params, values, analysis, args, stats)
+        if results is not None:
+            with stats.stage('load'):
+                sweep = SweepResult(params, values, [PlotResult(result.get_plots()[0], unary=analysis == 'op')
+                                                     for result in results])
+            self._report(stats)
+            return sweep
+        stats.engine = 'ngspice'
+
+        # Options such as .options interp stay in the netlist, only the analysis becomes a command
+        *options, command = Circuit.ANALYSES[analysis](self, *args).split("\n")
+        command = command.lstrip('.')
 
-        self._load_result(result)
+        control = [".control", "set filetype=binary", "set appendwrite"]
+        for i, param in enumerate(params):
+            control.append(F"foreach p{i} " + ' '.join(str(value) for value in values[i]))
+        for i, param in enumerate(params):
+            if isinstance(param, str):
+                control.append(F"alter {param} = $p{i}")
+            else:
+                component, attribute = param
+                control.append(component.alter(attribute, F"$p{i}"))
+        control += [command, F"write {RAW_FILE}", "destroy all"]
+        control += ["end"] * len(params)
+        control.append(".endc")
+
+        with stats.stage('generate'):
+            spice = self._deck(*options, *control)
+        raw = self._simulate(spice, stats)
+        with stats.stage('load'):
+            plots = [PlotResult(plot, unary=analysis == 'op') for plot in raw.get_plots()]
+            if len(plots) != numpy.prod([len(v) for v in values]):
+                raise Exception("ngspice returned", len(plots), "plots for a grid of", [len(v) for v in values])
+            sweep = SweepResult(params, values, plots)
+        self._report(stats)
+        return sweep
 
     def transient_analysis(self):
         pass
 
-    def _load_result(self, result, unary=False):
-        vec = result.get_plots()[0].get_scalevector()
-        #print(vec.name)
-        if vec.name == 'time':
-            self.time = vec.get_data()
-        elif vec.name == 'frequency':
-            self.frequency = vec.get_data()
-        else:
-            print(vec.name)
-            kind, node = re.search("([a-zA-Z]+)\(([-.a-zA-Z0-9]+)\)", vec.name).group(1, 2)
-            if kind == 'v':
-                if node.isdigit():
-                    self.operating_points[int(node)] = vec.get_data()[0] if unary else vec.get_data()
-                elif node == 'v-sweep':
-                    self.sweep = vec.get_data()
-                else:
-                    pass #print("Ignoring node", node, vec.get_data())
-            elif kind == 'i':
-                self.current[node] = vec.get_data()[0] if unary else vec.get_data()
-            else:
-                pass #print("Ignoring type", kind)
+    def _run(self, analysis, *args, unary=False, decimate=None):
+        stats = RunStats(analysis, self.engine)
+        result = self._analyze(analysis, *args, stats=stats)
+        with stats.stage('load'):
+            self._load_result(result, unary, decimate)
+        self._remember_operating_point(analysis, *args)
+        self._report(stats)
+
+    async def _run_async(self, analysis, *args, unary=False, decimate=None):
+        stats = RunStats(analysis, self.engine)
+        result = None
+        if self.engine != 'ngspice':
+            # A native solve is plain numpy work, run it off the event loop
+            result = await asyncio.get_running_loop().run_in_executor(None, self._native, analysis, args, stats)
+        if result is None:
+            with stats.stage('generate'):
+                spice = self._deck(Circuit.ANALYSES[analysis](self, *args))
+            result = await run_spice_async(spice, pool=self.pool, cache=self.cache, stats=stats)
+        with stats.stage('load'):
+            self._load_result(result, unary, decimate)
+        self._remember_operating_point(analysis, *args)
+        self._report(stats)
+
+    def _analyze(self, analysis, *args, stats=None):
+        if stats is None:
+            stats = RunStats(analysis, self.engine)
+        result = self._native(analysis, args, stats)
+        if result is not None:
+            return result
+        with stats.stage('generate'):
+            spice = self._deck(Circuit.ANALYSES[analysis](self, *args))
+        return self._simulate(spice, stats)
+
+    def _native(self, analysis, args, stats):
+        """ Result of the native engine, or None when the circuit should go to ngspice """
+        if self.engine == 'ngspice':
+            return None
+        import mna # mna builds on this module, so it can only be imported lazily
+        try:
+            with stats.stage('simulate'):
+                result = mna.simulate(self, analysis, *args)
+        except mna.UnsupportedCircuit:
+            if self.engine == 'native':
+                raise
+            stats.stages['native'] = stats.stages.pop('simulate')
+            stats.engine = 'ngspice'
+            return None
+        stats.engine = 'native'
+        stats.record_result(result)
+        return result
 
-        for vec in result.get_plots()[0].get_datavectors():
-            #print(vec.name)
-            kind, node = re.search("([a-zA-Z]+)\(([-.a-zA-Z0-9]+)\)", vec.name).group(1, 2)
+    def _simulate(self, spice, stats=None):
+        return run_spice(spice, pool=self.pool, cache=self.cache, stats=stats)
+
+    def _report(self, stats):
+        self.last_run_stats = stats
+        if self.stats_hook is not None:
+            self.stats_hook(stats)
+
+    def _load_result(self, result, unary=False, decimate=None):
+        self.result = SimulationResult(result, unary, decimate)
+        plot = self.result.plot(0)
+        self.operating_points = plot.operating_points
+        self.current = plot.current
+        for name in PlotResult.SCALES:
+            if getattr(plot, name) is not None:
+                setattr(self, name, getattr(plot, name))
+
+
+VECTOR_NAME = re.compile(r"([a-zA-Z]+)\(([-._a-zA-Z0-9]+)\)")
+
+class ResultTable(Mapping):
+    """ Node voltages or source currents of a plot, decoded on first access """
+
+    def __init__(self, plot, vectors):
+        self.plot = plot
+        self.vectors = vectors
+        self.decoded = {}
+
+    def __getitem__(self, key):
+        if key not in self.decoded:
+            data = self.vectors[key].get_data()
+            self.decoded[key] = data[0] if self.plot.unary else data[::self.plot.decimate]
+        return self.decoded[key]
+
+    def __iter__(self):
+        return iter(self.vectors)
+
+    def __len__(self):
+        return len(self.vectors)
+
+
+class PlotResult(object):
+    """
+    One plot of a simulation. Vector names are indexed once up front, their
+    data is only touched when a voltage or current is actually read.
+    """
+
+    SCALES = ('sweep', 'time', 'frequency')
+
+    def __init__(self, plot, unary=False, decimate=None):
+        self.plot = plot
+        self.plotname = plot.plotname
+        self.unary = unary
+        self.decimate = decimate # Keep every n-th point, slicing is free on binary raw files
+        self.sweep = self.time = self.frequency = None
+
+        voltages = {}
+        currents = {}
+        scale = plot.get_scalevector()
+        for vec in [scale] + plot.get_datavectors():
+            if vec is scale and vec.name in ('time', 'frequency'):
+                setattr(self, vec.name, vec.get_data()[::decimate])
+                continue
+            match = VECTOR_NAME.match(vec.name)
+            if match is None:
+                continue
+            kind, node = match.group(1, 2)
             if kind == 'v':
                 if node.isdigit():
-                    #print(node, vec.get_data())
-                    self.operating_points[int(node)] = vec.get_data()[0] if unary else vec.get_data()
+                    voltages[int(node)] = vec
+                elif vec is scale and node == 'v-sweep':
+                    self.sweep = vec.get_data()[::decimate]
                 else:
-                    pass #print("Ignoring node", node)
+                    voltages[node] = vec # nodes inside subcircuit instances
             elif kind == 'i':
-                self.current[node] = vec.get_data()[0] if unary else vec.get_data()
-            else:
-                pass #print("Ignoring type", kind)
+                currents[node] = vec
+        self.operating_points = ResultTable(self, voltages)
+        self.current = ResultTable(self, currents)
+
+    @property
+    def scale(self):
+        for name in PlotResult.SCALES:
+            if getattr(self, name) is not None:
+                return getattr(self, name)
+        return None
+
+    def voltage(self, port):
+        return self.operating_points[port.node]
+
+    def current_through(self, source):
+        return self.current.get(source.name.lower())
+
+
+class SimulationResult(object):
+    """ Every plot of one ngspice run, a plot is only indexed once it is asked for """
+
+    def __init__(self, raw, unary=False, decimate=None):
+        self.raw = raw
+        self.unary = unary
+        self.decimate = decimate
+        self.plots = [None] * len(raw.get_plots())
+
+    def plot(self, i):
+        if self.plots[i] is None:
+            self.plots[i] = PlotResult(self.raw.get_plots()[i], self.unary, self.decimate)
+        return self.plots[i]
+
+    def __len__(self):
+        return len(self.plots)
+
+    def __iter__(self):
+        return (self.plot(i) for i in range(len(self.plots)))
+
+
+class SweepResult(object):
+    """
+    Results of Circuit.parameter_sweep stacked into arrays with one leading axis per swept
+    parameter. Transient variants whose timesteps differ are interpolated onto
+    the time axis of the first variant so that they can be stacked.
+    """
+
+    def __init__(self, params, values, plots):
+        self.params = params
+        self.values = [numpy.array(v) for v in values]
+        self.shape = tuple(len(v) for v in values)
+
+        first = plots[0]
+        self.scale = first.scale
+        for name in PlotResult.SCALES:
+            setattr(self, name, getattr(first, name))
+
+        self.operating_points = self._stack([p.operating_points for p in plots], plots)
+        self.current = self._stack([p.current for p in plots], plots)
+
+    def _stack(self, tables, plots):
+        stacked = {}
+        for key in tables[0]:
+            columns = []
+            for table, plot in zip(tables, plots):
+                column = table[key]
+                if plot.time is not None and len(plot.time) != len(self.scale):
+                    column = numpy.interp(self.scale, plot.time, column)
+                columns.append(column)
+            stacked[key] = numpy.array(columns).reshape(self.shape + numpy.shape(columns[0]))
+        return stacked
+
+    def voltage(self, port):
+        return self.operating_points[port.node]
+
+    def current_through(self, source):
+        return self.current.get(source.name.lower())
+
 
 class Resistor(Component):
     IDX = 0
@@ -211,6 +942,11 @@ class Resistor(Component):
     def generate_spice(self):
         return F"{self.name} {self.pos.node} {self.neg.node} {self.resistance}"
 
+    def alter(self, attribute, value):
+        if attribute != 'resistance':
+            return Component.alter(self, attribute, value)
+        return F"alter {self.name} = {value}"
+
     def json(self):
         return {
                 'type': 'r_v',
@@ -239,6 +975,11 @@ class Capacitor(Component):
     def generate_spice(self):
         return F"{self.name} {self.pos.node} {self.neg.node} {self.capacitance}"
 
+    def alter(self, attribute, value):
+        if attribute != 'capacitance':
+            return Component.alter(self, attribute, value)
+        return F"alter {self.name} = {value}"
+
     def json(self):
         return {
                 'type': 'c_v',
@@ -251,8 +992,69 @@ class Capacitor(Component):
                 }}
 
 
+class ComponentArray(Component):
+    """
+    Many two terminal elements of one kind stored as numpy columns (pos node,
+    neg node, value) instead of one object each. Elements are named
+    <name>_<i> in the netlist. Nodes are plain integers, typically from
+    Circuit.new_nodes, with 0 for ground.
+    """
+    PREFIX = None
+    VALUE = None
+    SVG_TYPE = None
+
+    def __init__(self, circuit, pos, neg, value):
+        self.circuit = circuit
+        self.circuit.add(self)
+
+        self.pos, self.neg = numpy.broadcast_arrays(numpy.asarray(pos, dtype=numpy.int64),
+                                                    numpy.asarray(neg, dtype=numpy.int64))
+        setattr(self, self.VALUE, value)
+        self.ports = [] # Connected through the node columns, not connect()
+        self.name = self.PREFIX + str(type(self).IDX)
+        type(self).IDX += 1
+
+    def __len__(self):
+        return len(self.pos)
+
+    def values(self):
+        return numpy.broadcast_to(numpy.asarray(getattr(self, self.VALUE), dtype=float), self.pos.shape)
+
+    def generate_spice(self):
+        name = self.name
+        return "\n".join([F"{name}_{i} {pos} {neg} {value}" for i, (pos, neg, value)
+                          in enumerate(zip(self.pos.tolist(), self.neg.tolist(), self.values().tolist()))])
+
+    def cells(self):
+        return {F"{self.name}_{i}": {
+                    'type': self.SVG_TYPE,
+                    'connections': {
+                        'A': [neg],
+                        'B': [pos]
+                    },
+                    'attributes': {
+                        'value': str(value)
+                    }} for i, (pos, neg, value)
+                in enumerate(zip(self.pos.tolist(), self.neg.tolist(), self.values().tolist()))}
+
+
+class ResistorArray(ComponentArray):
+    """ ResistorArray(circuit, pos_nodes, neg_nodes, resistance), resistance may be a scalar or an array """
+    IDX = 0
+    PREFIX = "RA"
+    VALUE = 'resistance'
+    SVG_TYPE = 'r_v'
+
+
+class CapacitorArray(ComponentArray):
+    IDX = 0
+    PREFIX = "CA"
+    VALUE = 'capacitance'
+    SVG_TYPE = 'c_v'
+
+
 def import_subcircuit(circuit, file, name, *portnames, symbol=None):
-    circuit.imports.append(file)
+    circuit.import_library(file, name)
     
     class Subcircuit(Component):
         IDX = 0
@@ -292,7 +1094,91 @@ def import_subcircuit(circuit, file, name, *portnames, symbol=None):
                 raise Exception("Unknown symbol for subscircuit", name)
 
     return Subcircuit
- 
+
+class SubcircuitDefinition(object):
+    """ A Circuit fragment emitted as .SUBCKT name <port nodes> ... .ENDS """
+
+    def __init__(self, name, fragment, nodes):
+        self.name = name
+        self.fragment = fragment
+        self.nodes = nodes # Fragment node of every port, in order
+
+    def generate_spice(self):
+        nodes = ' '.join(str(node) for node in self.nodes)
+        return F".SUBCKT {self.name} {nodes}\n{self.fragment.generate_components()}.ENDS {self.name}\n"
+
+
+def define_subcircuit(circuit, fragment, name, **ports):
+    """
+    Turns fragment, a Circuit holding one copy of a block, into a subcircuit
+    of circuit, e.g. define_subcircuit(c, stage, 'STAGE', input=a, output=b)
+    where a and b are Ports (or node numbers) of the fragment. The .SUBCKT is
+    emitted once and every instance of the returned class is a single X line.
+    Every other fragment node is local to the instance, see Instance.node.
+    """
+    if any(definition.name == name for definition in circuit.subcircuits):
+        raise Exception("Subcircuit already defined", name)
+    portnames = list(ports.keys())
+    nodes = [port.node if isinstance(port, Port) else port for port in ports.values()]
+    if None in nodes or 0 in nodes:
+        raise Exception("Subcircuit ports must be connected to a node other than ground", name, ports)
+
+    # Anything the fragment depends on is defined once at the top level
+    for imp in fragment.imports:
+        circuit.import_library(imp, *(fragment.library_names.get(imp) or []))
+    for definition in fragment.subcircuits:
+        if definition not in circuit.subcircuits:
+            circuit.subcircuits.append(definition)
+    definition = SubcircuitDefinition(name, fragment, nodes)
+    circuit.subcircuits.append(definition)
+    external = {node: i for i, node in enumerate(nodes)}
+
+    class Instance(Component):
+        IDX = 0
+
+        def __init__(self, circuit):
+            self.circuit = circuit
+            self.circuit.add(self)
+
+            self.definition = definition
+            self.ports = [Port(circuit, component=self) for i in range(len(portnames))]
+            for i in range(len(portnames)):
+                setattr(self, portnames[i], self.ports[i])
+            self.name = F"X{name}_{Instance.IDX}"
+            Instance.IDX += 1
+
+        def generate_spice(self):
+            ports = ' '.join([str(p.node) for p in self.ports])
+            return F"{self.name} {ports} {name}"
+
+        def node(self, node):
+            """
+            Key of a fragment node (Port or number) of this instance in the
+            circuit's results: the connected node for ports, otherwise the
+            name ngspice gives the instance's local copy, e.g. 'xstage_3.5'
+            """
+            if isinstance(node, Port):
+                node = node.node
+            if node == 0:
+                return 0
+            if node in external:
+                return self.ports[external[node]].node
+            return F"{self.name.lower()}.{node}"
+
+        def voltage(self, node):
+            return self.circuit.operating_points[self.node(node)]
+
+        def json(self):
+            return {
+                'type': name,
+                'port_directions': {portname: 'input' for portname in portnames},
+                'connections': {portname: [port.node] for portname, port in zip(portnames, self.ports)},
+                'attributes': {
+
+                }}
+
+    return Instance
+
 # Note: this hasn't been tested
 class BipolarTransistor(Component):
     IDX = 0
@@ -362,6 +1248,11 @@ class Voltage(Component):
             isAC = ' ac' if self.ac else ''
             return F"{self.name} {self.pos.node} {self.neg.node}{isAC} {self.voltage}"
 
+    def alter(self, attribute, value):
+        if attribute != 'voltage' or self.piecewise or self.sin:
+            return Component.alter(self, attribute, value)
+        return F"alter {self.name} {'acmag' if self.ac else 'dc'} = {value}"
+
     def json(self):
         return {
                 'type': 'v',
@@ -0,0 +1,392 @@
+"""
+Measurements over simulation results: crossings, rise time, overshoot,
+settling, peak, RMS, bandwidth and gain/phase margin.
+
+The functions are numpy reductions along the last axis. Leading axes are
+batch axes, so one call measures every run of a SweepResult at once:
+
+    sweep = c.parameter_sweep({(r, 'resistance'): [1e3, 2e3, 4e3]}, 'tran', 1e-6, 1e-9)
+    rise_time(sweep.time, sweep.voltage(out))    # shape (3,)
+
+The Measure classes wrap the same computations around a Port or Voltage
+source. evaluate() runs them on a Circuit, PlotResult or SweepResult. Most
+of them can also be compiled to ngspice .meas statements
+(run_measurements / sweep_measurements), so that only the scalars come
+back from ngspice instead of whole waveforms.
+"""
+
+from main import Circuit, Port, Voltage
+from concurrent.futures import ProcessPoolExecutor
+from subprocess import Popen, PIPE, STDOUT
+import itertools
+import main
+import numpy
+import os
+import re
+
+
+def _take(array, index):
+    return numpy.take_along_axis(array, index[..., None], axis=-1)[..., 0]
+
+
+def _real(y):
+    """ y as real values, the magnitude of complex (AC) signals like ngspice's vm() """
+    y = numpy.asarray(y)
+    return numpy.abs(y) if numpy.iscomplexobj(y) else y
+
+
+def crossing(x, y, level=0.0, direction=None, occurrence=1, log_x=False):
+    """
+    x where y crosses level for the occurrence-th time, linearly interpolated
+    (in log x with log_x), NaN if it never does. direction is 'rise', 'fall'
+    or None for either. level may hold one value per batch entry. Complex y
+    is crossed by its magnitude.
+    """
+    y = _real(y)
+    x = numpy.broadcast_to(x, y.shape)
+    d = y - numpy.asarray(level)[..., None]
+    before, after = d[..., :-1], d[..., 1:]
+    rising = (before < 0) & (after >= 0)
+    falling = (before > 0) & (after <= 0)
+    hits = rising if direction == 'rise' else falling if direction == 'fall' else rising | falling
+    hits = hits & (numpy.cumsum(hits, axis=-1) == occurrence)
+    found = hits.any(axis=-1)
+    i = hits.argmax(axis=-1)
+
+    a, b = _take(before, i), _take(after, i)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        fraction = numpy.where(a == b, 0.0, a / (a - b))
+    x0, x1 = _take(x[..., :-1], i), _take(x[..., 1:], i)
+    if log_x:
+        at = numpy.exp(numpy.log(x0) + fraction * (numpy.log(x1) - numpy.log(x0)))
+    else:
+        at = x0 + fraction * (x1 - x0)
+    return numpy.where(found, at, numpy.nan)
+
+
+def value_at(x, y, at, log_x=False):
+    """ y interpolated at x = at, x being the shared 1-D scale, at a scalar or one value per batch entry """
+    x = numpy.log(x) if log_x else numpy.asarray(x)
+    at = numpy.log(at) if log_x else numpy.asarray(at, dtype=float)
+    y = numpy.asarray(y)
+    batch = y.shape[:-1]
+    i = numpy.clip(numpy.searchsorted(x, at) - 1, 0, len(x) - 2)
+    i = numpy.broadcast_to(i, batch).copy()
+    at = numpy.broadcast_to(at, batch)
+    x0, x1 = x[i], x[i + 1]
+    fraction = (at - x0) / (x1 - x0)
+    result = _take(y, i) + fraction * (_take(y, i + 1) - _take(y, i))
+    return numpy.where(numpy.isnan(at), numpy.nan, result)
+
+
+def _swing(y):
+    y = numpy.asarray(y)
+    return y[..., 0], y[..., -1], y[..., -1] - y[..., 0]
+
+
+def rise_time(t, y, low=0.1, high=0.9):
+    """ Time from low to high (fractions of the initial to final swing), for falling edges too """
+    initial, final, swing = _swing(y)
+    return numpy.abs(crossing(t, y, initial + high * swing) - crossing(t, y, initial + low * swing))
+
+
+def overshoot(y):
+    """ How far y goes past its final value, as a fraction of the initial to final swing """
+    y = numpy.asarray(y)
+    initial, final, swing = _swing(y)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        beyond = numpy.max((y - final[..., None]) * numpy.sign(swing)[..., None], axis=-1)
+        return numpy.maximum(beyond, 0.0) / numpy.abs(swing)
+
+
+def settling_time(t, y, tolerance=0.02):
+    """ Time after t[0] from which y stays within tolerance (a fraction of the swing) of its final value """
+    y = numpy.asarray(y)
+    t = numpy.broadcast_to(t, y.shape)
+    initial, final, swing = _swing(y)
+    outside = numpy.abs(y - final[..., None]) > tolerance * numpy.abs(swing)[..., None]
+    # Index of the last point outside the band, counted from the end
+    last = y.shape[-1] - 1 - outside[..., ::-1].argmax(axis=-1)
+    settled = numpy.minimum(last + 1, y.shape[-1] - 1)
+    return numpy.where(outside.any(axis=-1), _take(t, settled), t[..., 0]) - t[..., 0]
+
+
+def peak(y):
+    """ Maximum of y, of its magnitude when complex """
+    return numpy.max(_real(y), axis=-1)
+
+
+def peak_at(x, y):
+    """ x of the maximum of y (of its magnitude when complex) """
+    y = _real(y)
+    return _take(numpy.broadcast_to(x, y.shape), y.argmax(axis=-1))
+
+
+def _trapezoid(t, y):
+    t = numpy.broadcast_to(t, y.shape)
+    return numpy.sum(0.5 * (y[..., 1:] + y[..., :-1]) * numpy.diff(t, axis=-1), axis=-1)
+
+
+def average(t, y):
+    """ Time average of y, the timepoints of a transient need not be uniform """
+    t = numpy.asarray(t)
+    return _trapezoid(t, numpy.asarray(y)) / (t[..., -1] - t[..., 0])
+
+
+def rms(t, y):
+    t = numpy.asarray(t)
+    return numpy.sqrt(_trapezoid(t, numpy.asarray(y) ** 2) / (t[..., -1] - t[..., 0]))
+
+
+def db(h):
+    return 20 * numpy.log10(numpy.abs(h))
+
+
+def phase(h):
+    """ Unwrapped phase in degrees """
+    return numpy.degrees(numpy.unwrap(numpy.angle(h), axis=-1))
+
+
+def bandwidth(f, h, drop=-3.0):
+    """ First frequency where the gain falls drop dB below its value at the lowest frequency """
+    gain = db(h)
+    return crossing(f, gain, gain[..., 0] + drop, direction='fall', log_x=True)
+
+
+def unity_gain_frequency(f, h):
+    return crossing(f, db(h), 0.0, direction='fall', log_x=True)
+
+
+def phase_margin(f, h):
+    """ 180 degrees plus the phase of the loop gain h where |h| falls through 1 """
+    ugf = unity_gain_frequency(f, h)
+    return 180.0 + value_at(f, phase(h), ugf, log_x=True)
+
+
+def gain_margin(f, h):
+    """ How far |h| is below 0 dB where its phase falls through -180 degrees """
+    crossover = crossing(f, phase(h), -180.0, direction='fall', log_x=True)
+    return -value_at(f, db(h), crossover, log_x=True)
+
+
+class Measure(object):
+    """ A named measurement of one Port voltage (or Voltage source current) """
+    ANALYSIS = 'tran'
+    SCALES = {'tran': 'time', 'ac': 'frequency', 'dc': 'sweep'}
+
+    def __init__(self, name, target, analysis=None):
+        self.name = name
+        self.target = target
+        self.analysis = analysis or self.ANALYSIS
+
+    def magnitude(self, result):
+        """ The signal as .meas sees the vector(): magnitudes in AC analyses """
+        return _real(self.signal(result))
+
+    def signal(self, result):
+        target = self.target
+        if isinstance(target, Voltage):
+            return result.current[target.name.lower()]
+        if isinstance(target, Port):
+            target = target.node
+        return result.operating_points[target]
+
+    def scale(self, result):
+        return getattr(result, Measure.SCALES[self.analysis])
+
+    def vector(self, function=None):
+        """
+        The ngspice name of the measured vector, function being v, vm, vdb or vp
+        for voltages. It defaults to vm in AC analyses, matching magnitude().
+        """
+        function = function or ('vm' if self.analysis == 'ac' else 'v')
+        if isinstance(self.target, Voltage):
+            if function != 'v':
+                raise Exception("No .meas form for the", function, "of a current", self.name)
+            return F"i({self.target.name.lower()})"
+        node = self.target.node if isinstance(self.target, Port) else self.target
+        return F"{function}({node})"
+
+    def evaluate(self, result):
+        """ The measured value(s) of a Circuit, PlotResult or SweepResult """
+        raise Exception("No evaluation for", type(self).__name__, self.name)
+
+    def meas(self):
+        """ The .meas statements computing this measurement in ngspice """
+        raise Exception("No .meas form for", type(self).__name__, self.name)
+
+
+class When(Measure):
+    """ Scale value (time, frequency...) where the signal crosses level """
+
+    def __init__(self, name, target, level, direction='rise', occurrence=1, analysis=None):
+        Measure.__init__(self, name, target, analysis)
+        self.level = level
+        self.direction = direction
+        self.occurrence = occurrence
+
+    def evaluate(self, result):
+        return crossing(self.scale(result), self.magnitude(result), self.level, self.direction, self.occurrence,
+                        log_x=self.analysis == 'ac')
+
+    def meas(self):
+        edge = {'rise': 'RISE', 'fall': 'FALL', None: 'CROSS'}[self.direction]
+        return [F".meas {self.analysis} {self.name} WHEN {self.vector()}={self.level} {edge}={self.occurrence}"]
+
+
+class RiseTime(Measure):
+    """ low and high are fractions of the swing, or absolute levels with absolute=True (needed for .meas) """
+
+    def __init__(self, name, target, low=0.1, high=0.9, absolute=False):
+        Measure.__init__(self, name, target)
+        self.low = low
+        self.high = high
+        self.absolute = absolute
+
+    def evaluate(self, result):
+        t, y = self.scale(result), self.signal(result)
+        if not self.absolute:
+            return rise_time(t, y, self.low, self.high)
+        return numpy.abs(crossing(t, y, self.high) - crossing(t, y, self.low))
+
+    def meas(self):
+        if not self.absolute:
+            return Measure.meas(self)
+        vector = self.vector()
+        return [F".meas tran {self.name} TRIG {vector} VAL={self.low} CROSS=1 TARG {vector} VAL={self.high} CROSS=1"]
+
+
+class Overshoot(Measure):
+    def evaluate(self, result):
+        return overshoot(self.signal(result))
+
+
+class SettlingTime(Measure):
+    def __init__(self, name, target, tolerance=0.02):
+        Measure.__init__(self, name, target)
+        self.tolerance = tolerance
+
+    def evaluate(self, result):
+        return settling_time(self.scale(result), self.signal(result), self.tolerance)
+
+
+class Peak(Measure):
+    def evaluate(self, result):
+        return peak(self.magnitude(result))
+
+    def meas(self):
+        return [F".meas {self.analysis} {self.name} MAX {self.vector()}"]
+
+
+class RMS(Measure):
+    def evaluate(self, result):
+        return rms(self.scale(result), self.magnitude(result))
+
+    def meas(self):
+        return [F".meas {self.analysis} {self.name} RMS {self.vector()}"]
+
+
+class ValueAt(Measure):
+    """ The signal at one point of the scale, e.g. the current of a source at a DC bias point """
+
+    def __init__(self, name, target, at, analysis=None):
+        Measure.__init__(self, name, target, analysis)
+        self.at = at
+
+    def evaluate(self, result):
+        return value_at(self.scale(result), self.magnitude(result), self.at)
+
+    def meas(self):
+        return [F".meas {self.analysis} {self.name} FIND {self.vector()} AT={self.at}"]
+
+
+class Bandwidth(Measure):
+    """ -3 dB (or drop dB) frequency, relative to reference dB if given (needed for .meas) or the lowest frequency """
+    ANALYSIS = 'ac'
+
+    def __init__(self, name, target, drop=-3.0, reference=None):
+        Measure.__init__(self, name, target)
+        self.drop = drop
+        self.reference = reference
+
+    def evaluate(self, result):
+        f, h = self.scale(result), self.signal(result)
+        if self.reference is None:
+            return bandwidth(f, h, self.drop)
+        return crossing(f, db(h), self.reference + self.drop, direction='fall', log_x=True)
+
+    def meas(self):
+        if self.reference is None:
+            return Measure.meas(self)
+        return [F".meas ac {self.name} WHEN {self.vector('vdb')}={self.reference + self.drop} FALL=1"]
+
+
+class PhaseMargin(Measure):
+    """ Of the loop gain at target """
+    ANALYSIS = 'ac'
+
+    def evaluate(self, result):
+        return phase_margin(self.scale(result), self.signal(result))
+
+
+class GainMargin(Measure):
+    ANALYSIS = 'ac'
+
+    def evaluate(self, result):
+        return gain_margin(self.scale(result), self.signal(result))
+
+
+def evaluate(measures, result):
+    """ {name: value} of every measure on a Circuit, PlotResult or SweepResult """
+    return {measure.name: measure.evaluate(result) for measure in measures}
+
+
+MEAS_RESULT = re.compile(r"^\s*([a-z_][\w.]*)\s*=\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:e[-+]?\d+)?)", re.I | re.M)
+
+def parse_measurements(output, measures):
+    """ Picks the .meas results out of ngspice's output, NaN for the ones that failed """
+    found = {}
+    for name, value in MEAS_RESULT.findall(output):
+        found.setdefault(name.lower(), float(value))
+    return {measure.name: found.get(measure.name.lower(), numpy.nan) for measure in measures}
+
+
+def spice_output(spice):
+    """ Runs a deck in batch mode without writing a raw file and returns what ngspice printed """
+    output, _ = Popen(main.NGSPICE + ['-b'], stdin=PIPE, stdout=PIPE, stderr=STDOUT).communicate(spice.encode())
+    return output.decode(errors='replace')
+
+
+def measurement_deck(circuit, measures, analysis, *args):
+    lines = [line for measure in measures for line in measure.meas()]
+    return circuit._deck(Circuit.ANALYSES[analysis](circuit, *args), *lines)
+
+
+def run_measurements(circuit, measures, analysis='tran', *args):
+    """ Runs analysis with the measures compiled to .meas, only the scalars come back """
+    return parse_measurements(spice_output(measurement_deck(circuit, measures, analysis, *args)), measures)
+
+
+def sweep_measurements(circuit, grid, measures, analysis='tran', *args, processes=None):
+    """
+    run_measurements for every point of grid (as for Circuit.parameter_sweep),
+    in parallel. Returns {name: array} with one axis per swept parameter.
+    """
+    params = list(grid.keys())
+    values = [list(grid[param]) for param in params]
+    originals = [getattr(component, attribute) for component, attribute in params]
+    decks = []
+    try:
+        for point in itertools.product(*values):
+            for (component, attribute), value in zip(params, point):
+                setattr(component, attribute, value)
+            decks.append(measurement_deck(circuit, measures, analysis, *args))
+    finally:
+        for (component, attribute), value in zip(params, originals):
+            setattr(component, attribute, value)
+
+    with ProcessPoolExecutor(processes or os.cpu_count()) as executor:
+        outputs = list(executor.map(spice_output, decks))
+    shape = tuple(len(v) for v in values)
+    results = [parse_measurements(output, measures) for output in outputs]
+    return {measure.name: numpy.array([r[measure.name] for r in results]).reshape(shape) for measure in measures}
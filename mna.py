@@ -0,0 +1,449 @@
+"""
+Built-in modified nodal analysis engine for linear circuits.
+
+Circuits made only of Resistors, Capacitors (single or as ResistorArray and
+CapacitorArray) and Voltage sources can be solved
+directly with numpy (and scipy's sparse LU for large transients, when it is
+installed) instead of launching ngspice. The results are returned in
+the same shape ngspice_read produces (plots of spice_vectors named v(N) and
+i(source)), so Circuit._load_result and everything downstream is unchanged.
+
+    c = Circuit(engine='native')   # or 'auto' to fall back to ngspice
+    c.compute_ac_sweep(1, 1e8, 10)
+"""
+
+from main import Resistor, Capacitor, Voltage, ResistorArray, CapacitorArray, run_spice
+from ngspice_read import spice_plot, spice_vector
+import numpy
+import re
+try:
+    import scipy.linalg
+    import scipy.sparse
+    import scipy.sparse.linalg
+except ImportError:
+    scipy = None
+
+# Systems with more unknowns than this are factored as sparse matrices
+SPARSE_SIZE = 200
+
+# Conductance (S) holding a node at its initial condition while a transient's
+# initial operating point is solved
+CLAMP = 1e10
+
+
+class UnsupportedCircuit(Exception):
+    pass
+
+
+SUFFIXES = {'t': 1e12, 'g': 1e9, 'meg': 1e6, 'k': 1e3, 'm': 1e-3, 'u': 1e-6, 'n': 1e-9, 'p': 1e-12, 'f': 1e-15}
+NUMBER = re.compile(r"^([-+]?(?:\d+\.?\d*|\.\d+)(?:e[-+]?\d+)?)(meg|[tgkmunpf])?[a-z]*$")
+
+def spice_number(value):
+    """ Converts a component value, either a number or a SPICE string like '4.7k', to float """
+    if isinstance(value, str):
+        match = NUMBER.match(value.strip().lower())
+        if match is None:
+            raise UnsupportedCircuit("Not a number", value)
+        return float(match.group(1)) * SUFFIXES.get(match.group(2), 1)
+    return float(value)
+
+
+def dc_value(source):
+    """ The value ngspice uses for a source in DC analyses """
+    if source.piecewise:
+        return spice_number(source.piecewise[1]) # PWL holds its first value before the first point
+    elif source.sin:
+        return spice_number(source.offset)
+    elif source.ac:
+        return 0.0 # 'ac <value>' only sets the AC magnitude
+    return spice_number(source.voltage)
+
+
+def ac_value(source):
+    if source.ac and not source.piecewise and not source.sin:
+        return spice_number(source.voltage)
+    return 0.0
+
+
+def sweep_values(start, stop, step):
+    """ The points ngspice visits for one .dc sweep """
+    start, stop, step = spice_number(start), spice_number(stop), spice_number(step)
+    count = int(numpy.floor((stop - start) / step + 1e-9)) + 1
+    return start + step * numpy.arange(count)
+
+
+class MNASystem(object):
+    """
+    G x = b for the DC solution, (G + jwC) x = b for AC and G x + C dx/dt = b(t)
+    for transients, with one unknown per node (ground excluded) followed by one
+    branch current per source. G and C are stamped as (row, column, value)
+    triplets so that large systems can be assembled as sparse matrices.
+    """
+
+    def __init__(self, circuit):
+        self.circuit = circuit
+        self.resistors = []
+        self.capacitors = []
+        self.sources = []
+        self.arrays = []
+        for component in circuit.components:
+            if isinstance(component, (ResistorArray, CapacitorArray)):
+                self.arrays.append(component)
+            elif isinstance(component, Resistor):
+                self.resistors.append(component)
+            elif isinstance(component, Capacitor):
+                self.capacitors.append(component)
+            elif isinstance(component, Voltage):
+                self.sources.append(component)
+            else:
+                raise UnsupportedCircuit("The native engine only handles Resistor, Capacitor and Voltage", component.name)
+
+        nodes = set()
+        for component in circuit.components:
+            for port in self.ports(component):
+                if port.node is None:
+                    raise UnsupportedCircuit("Unconnected port on", component.name)
+                nodes.add(port.node)
+        node_array = numpy.unique(numpy.concatenate([numpy.fromiter(nodes, dtype=numpy.int64, count=len(nodes))] +
+                                                    [numpy.concatenate([a.pos, a.neg]) for a in self.arrays]))
+        self.node_array = node_array[node_array != 0]
+        self.nodes = self.node_array.tolist()
+        self.index = {node: i for i, node in enumerate(self.nodes)}
+        self.size = len(self.nodes) + len(self.sources)
+
+        # Scalar rows, columns and values from add(), plus whole arrays of them from stamp_array()
+        self.g_entries = ([], [], [], [])
+        self.c_entries = ([], [], [], [])
+        for resistor in self.resistors:
+            self.stamp(self.g_entries, resistor, 1.0 / spice_number(resistor.resistance))
+        for capacitor in self.capacitors:
+            self.stamp(self.c_entries, capacitor, spice_number(capacitor.capacitance))
+        for array in self.arrays:
+            if isinstance(array, ResistorArray):
+                self.stamp_array(self.g_entries, array, 1.0 / array.values())
+            else:
+                self.stamp_array(self.c_entries, array, array.values())
+        for k, source in enumerate(self.sources):
+            row = len(self.nodes) + k
+            for port, sign in ((source.pos, 1.0), (source.neg, -1.0)):
+                if port.node != 0:
+                    i = self.index[port.node]
+                    self.add(self.g_entries, i, row, sign)
+                    self.add(self.g_entries, row, i, sign)
+        self._G = self._C = None
+
+    @property
+    def G(self):
+        if self._G is None:
+            self._G = self.dense(self.g_entries)
+        return self._G
+
+    @property
+    def C(self):
+        if self._C is None:
+            self._C = self.dense(self.c_entries)
+        return self._C
+
+    @staticmethod
+    def triplets(entries):
+        rows, columns, values, blocks = entries
+        return (numpy.concatenate([numpy.array(rows, dtype=int)] + [block[0] for block in blocks]),
+                numpy.concatenate([numpy.array(columns, dtype=int)] + [block[1] for block in blocks]),
+                numpy.concatenate([numpy.array(values, dtype=float)] + [block[2] for block in blocks]))
+
+    def dense(self, entries):
+        matrix = numpy.zeros((self.size, self.size))
+        rows, columns, values = self.triplets(entries)
+        numpy.add.at(matrix, (rows, columns), values)
+        return matrix
+
+    def sparse(self, entries):
+        rows, columns, values = self.triplets(entries)
+        # Duplicate entries are summed on conversion
+        return scipy.sparse.coo_matrix((values, (rows, columns)), shape=(self.size, self.size)).tocsc()
+
+    def factorize(self, g_weight, c_weight):
+        """
+        Factors g_weight * G + c_weight * C once and returns a function solving
+        it for any right hand side: sparse LU for large systems, dense LU for
+        small ones, and a precomputed inverse when scipy is not installed.
+        """
+        try:
+            if scipy is not None and self.size > SPARSE_SIZE:
+                lu = scipy.sparse.linalg.splu(g_weight * self.sparse(self.g_entries) + c_weight * self.sparse(self.c_entries))
+                return lu.solve
+            matrix = g_weight * self.G + c_weight * self.C
+            if scipy is not None:
+                lu = scipy.linalg.lu_factor(matrix, check_finite=False)
+                if numpy.any(numpy.diag(lu[0]) == 0):
+                    raise numpy.linalg.LinAlgError()
+                return lambda b: scipy.linalg.lu_solve(lu, b, check_finite=False)
+            inverse = numpy.linalg.inv(matrix)
+            return lambda b: inverse @ b
+        except (numpy.linalg.LinAlgError, RuntimeError):
+            raise UnsupportedCircuit("Singular matrix, is a node only connected through capacitors?")
+
+    @staticmethod
+    def add(entries, row, column, value):
+        entries[0].append(row)
+        entries[1].append(column)
+        entries[2].append(value)
+
+    @staticmethod
+    def ports(component):
+        if isinstance(component, Voltage):
+            return [component.pos, component.neg]
+        return component.ports
+
+    def stamp(self, entries, component, value):
+        a, b = [None if port.node == 0 else self.index[port.node] for port in component.ports]
+        if a is not None:
+            self.add(entries, a, a, value)
+        if b is not None:
+            self.add(entries, b, b, value)
+        if a is not None and b is not None:
+            self.add(entries, a, b, -value)
+            self.add(entries, b, a, -value)
+
+    def stamp_array(self, entries, array, values):
+        """ stamp() for every element of a ComponentArray at once """
+        a = numpy.searchsorted(self.node_array, array.pos)
+        b = numpy.searchsorted(self.node_array, array.neg)
+        a_connected, b_connected = array.pos != 0, array.neg != 0
+        both = a_connected & b_connected
+        entries[3].append((numpy.concatenate([a[a_connected], b[b_connected], a[both], b[both]]),
+                           numpy.concatenate([a[a_connected], b[b_connected], b[both], a[both]]),
+                           numpy.concatenate([values[a_connected], values[b_connected], -values[both], -values[both]])))
+
+    def rhs(self, values):
+        b = numpy.zeros(self.size, dtype=numpy.result_type(*values) if values else float)
+        b[len(self.nodes):] = values
+        return b
+
+    def solve_dc(self, b):
+        """ b may hold one right hand side per column, the factorization is shared """
+        return self.factorize(1.0, 0.0)(b)
+
+    def solve_clamped(self, b, voltages):
+        """ solve_dc with the nodes of voltages (node -> voltage) held at their values, as .ic does """
+        b = numpy.array(b, dtype=float)
+        rows = [self.index[node] for node in voltages if node in self.index]
+        b[rows] += CLAMP * numpy.array([voltages[self.nodes[row]] for row in rows])
+        try:
+            if scipy is not None and self.size > SPARSE_SIZE:
+                clamp = scipy.sparse.coo_matrix((numpy.full(len(rows), CLAMP), (rows, rows)), shape=(self.size, self.size))
+                return scipy.sparse.linalg.splu((self.sparse(self.g_entries) + clamp).tocsc()).solve(b)
+            G = self.G.copy()
+            G[rows, rows] += CLAMP
+            return numpy.linalg.solve(G, b)
+        except (numpy.linalg.LinAlgError, RuntimeError):
+            raise UnsupportedCircuit("Singular matrix, is a node only connected through capacitors?")
+
+    def solve_ac(self, frequencies):
+        """ Solves every frequency point at once on a stacked (F, N, N) complex system """
+        b = self.rhs([complex(ac_value(source)) for source in self.sources])
+        A = self.G[None, :, :] + 2j * numpy.pi * frequencies[:, None, None] * self.C[None, :, :]
+        return numpy.linalg.solve(A, numpy.broadcast_to(b[:, None], (len(frequencies), self.size, 1)))[:, :, 0].T
+
+    def plot(self, plotname, x, scale=None):
+        """ Wraps the solution rows of x (one per unknown) as an ngspice_read plot """
+        plot = spice_plot(plotname=plotname, title="native", plottype="native")
+        vectors = [spice_vector(x[i], name=F"v({node})", type="voltage") for node, i in self.index.items()]
+        vectors += [spice_vector(x[len(self.nodes) + k], name=F"i({source.name.lower()})", type="current")
+                    for k, source in enumerate(self.sources)]
+        if self.circuit.probes:
+            # Same vectors ngspice would write for the circuit's .save
+            vectors = [vec for vec in vectors if vec.name in self.circuit.probes]
+        if scale is None:
+            # .op files have no scale, the first vector takes its place
+            plot.set_scalevector(vectors[0])
+            plot.set_datavectors(vectors[1:])
+        else:
+            plot.set_scalevector(scale)
+            plot.set_datavectors(vectors)
+        return plot
+
+
+class NativeResult(object):
+    """ Quacks like ngspice_read """
+
+    def __init__(self, plots):
+        self.plots = plots
+
+    def get_plots(self):
+        return self.plots
+
+
+def operating_point(system):
+    x = system.solve_dc(system.rhs([dc_value(source) for source in system.sources]))
+    return system.plot("Operating Point", x[:, None])
+
+
+def dc_sweep(system, *sweeps):
+    if len(sweeps) > 2:
+        raise UnsupportedCircuit("ngspice sweeps at most two sources")
+    base = [dc_value(source) for source in system.sources]
+    grids = []
+    for component, start, stop, step in sweeps:
+        if component not in system.sources:
+            raise UnsupportedCircuit("The native engine only sweeps voltage sources", component.name)
+        grids.append((system.sources.index(component), sweep_values(start, stop, step)))
+
+    # The first sweep varies fastest, like ngspice
+    columns = numpy.tile(numpy.array(base)[:, None], numpy.prod([len(values) for _, values in grids]))
+    repeat = 1
+    for k, values in grids:
+        columns[k] = numpy.tile(numpy.repeat(values, repeat), columns.shape[1] // (repeat * len(values)))
+        repeat *= len(values)
+    b = numpy.zeros((system.size, columns.shape[1]))
+    b[len(system.nodes):] = columns
+
+    x = system.solve_dc(b)
+    scale = spice_vector(columns[grids[0][0]], name="v(v-sweep)", type="voltage")
+    return system.plot("DC transfer characteristic", x, scale)
+
+
+def ac_frequencies(start, stop, points, linear=False):
+    start, stop = spice_number(start), spice_number(stop)
+    if linear:
+        return numpy.linspace(start, stop, int(points))
+    count = int(numpy.floor(numpy.log10(stop / start) * int(points) + 1e-9)) + 1
+    return start * 10 ** (numpy.arange(count) / int(points))
+
+
+def ac_sweep(system, start, stop, points, linear=False):
+    frequencies = ac_frequencies(start, stop, points, linear)
+    x = system.solve_ac(frequencies)
+    scale = spice_vector(frequencies, name="frequency", type="frequency")
+    return system.plot("AC Analysis", x, scale)
+
+
+def source_values(source, times):
+    """ The value of source at each of times, like ngspice's PWL and SIN sources """
+    if source.piecewise:
+        points = [spice_number(value) for value in source.piecewise]
+        return numpy.interp(times, points[0::2], points[1::2])
+    elif source.sin:
+        offset, amplitude, freq = [spice_number(value) for value in (source.offset, source.amplitude, source.freq)]
+        return offset + amplitude * numpy.sin(2 * numpy.pi * freq * times)
+    return numpy.full(len(times), dc_value(source))
+
+
+def transient(system, stop, step, start=None, max_step=None, interp=False, method='trap'):
+    """
+    Fixed step integration of G x + C dx/dt = b(t) from the operating point at
+    t = 0 (with the circuit's initial_guess as initial conditions under
+    warm_start='ic'). The system matrix only depends on the step, so it is factored once
+    and every time step is a single forward/back substitution. method is
+    'trap' (trapezoidal) or 'euler' (backward Euler).
+
+    A max_step below step splits every step into equal substeps. Only the
+    points on the step grid from start on are stored. The output is always
+    uniform, so interp changes nothing here.
+    """
+    stop, step = spice_number(stop), spice_number(step)
+    start = 0.0 if start is None else spice_number(start)
+    substeps = 1 if max_step is None else max(1, int(numpy.ceil(step / spice_number(max_step) - 1e-9)))
+    h = step / substeps
+    times = h * numpy.arange(int(numpy.floor(stop / h + 1e-9)) + 1)
+    keep = (numpy.arange(len(times)) % substeps == 0) & (times >= start - 1e-9 * h)
+
+    # Only the source rows of b(t) vary, so just those are tabulated
+    first = len(system.nodes)
+    sources = numpy.zeros((len(system.sources), len(times)))
+    for k, source in enumerate(system.sources):
+        sources[k] = source_values(source, times)
+    b = numpy.zeros(system.size)
+
+    x_out = numpy.empty((system.size, numpy.count_nonzero(keep)))
+    b[first:] = sources[:, 0]
+    circuit = system.circuit
+    clamped = circuit.warm_start == 'ic' and bool(circuit.initial_guess)
+    if clamped:
+        # Like ngspice's .ic, the remembered node voltages are held while the operating point is solved
+        x = system.solve_clamped(b, circuit.initial_guess)
+    else:
+        x = system.solve_dc(b)
+    stored = 0
+    if keep[0]:
+        x_out[:, 0] = x
+        stored = 1
+    if scipy is not None and system.size > SPARSE_SIZE:
+        G, C = system.sparse(system.g_entries), system.sparse(system.c_entries)
+    else:
+        G, C = system.G, system.C
+
+    if method == 'trap':
+        # Capacitor currents y = C dx/dt follow the trapezoidal companion model
+        # y[n+1] = 2C/h (x[n+1] - x[n]) - y[n], which leaves the algebraic
+        # unknowns (source currents) free of trapezoidal ringing.
+        solve = system.factorize(1.0, 2.0 / h)
+        y = numpy.zeros(system.size) # no capacitor current at the operating point
+        if clamped:
+            # ...unless initial conditions held it, then it is whatever G x leaves over
+            dynamic = numpy.asarray(abs(C).sum(axis=1)).ravel() != 0
+            y[dynamic] = (b - G @ x)[dynamic]
+    elif method == 'euler':
+        solve = system.factorize(1.0, 1.0 / h)
+    else:
+        raise Exception("Unknown integration method", method)
+    for n in range(1, len(times)):
+        b[first:] = sources[:, n]
+        if method == 'trap':
+            history = C @ x * (2.0 / h)
+            x = solve(b + history + y)
+            y = C @ x * (2.0 / h) - history - y
+        else:
+            x = solve(b + C @ x / h)
+        if keep[n]:
+            x_out[:, stored] = x
+            stored += 1
+
+    scale = spice_vector(times[keep], name="time", type="time")
+    return system.plot("Transient Analysis", x_out, scale)
+
+
+ANALYSES = {
+    'op': operating_point,
+    'dc': dc_sweep,
+    'ac': ac_sweep,
+    'tran': transient,
+}
+
+def simulate(circuit, analysis, *args, **options):
+    """ Runs analysis ('op', 'dc', 'ac', 'tran') natively, raises UnsupportedCircuit if it can't """
+    if analysis not in ANALYSES:
+        raise UnsupportedCircuit("No native", analysis, "analysis")
+    return NativeResult([ANALYSES[analysis](MNASystem(circuit), *args, **options)])
+
+
+def compare(circuit, analysis, *args, **options):
+    """
+    Runs analysis both natively and with ngspice and returns the largest
+    absolute difference of every vector, as a cross-check of the native engine.
+    Native transients are interpolated onto ngspice's (adaptive) timepoints.
+    """
+    native = simulate(circuit, analysis, *args, **options).get_plots()[0]
+    directive = circuit.ANALYSES[analysis](circuit, *args)
+    reference = run_spice(circuit._deck(directive)).get_plots()[0]
+    if analysis == 'op':
+        # Which vector ngspice picks as the scale of an .op plot is arbitrary
+        native_vectors = [native.get_scalevector()] + native.get_datavectors()
+        reference_vectors = [reference.get_scalevector()] + reference.get_datavectors()
+    else:
+        native_vectors = native.get_datavectors()
+        reference_vectors = reference.get_datavectors()
+        native_scale = native.get_scalevector().get_data()
+        reference_scale = reference.get_scalevector().get_data()
+        if analysis != 'tran' and len(native_scale) != len(reference_scale):
+            raise Exception("Native and ngspice results have different scales")
+
+    reference_data = {vec.name: vec.get_data() for vec in reference_vectors}
+    differences = {}
+    for vec in native_vectors:
+        if vec.name in reference_data:
+            data = vec.get_data()
+            if analysis == 'tran':
+                data = numpy.interp(reference_scale, native_scale, data)
+            differences[vec.name] = numpy.max(numpy.abs(data - reference_data[vec.name]))
+    return differences
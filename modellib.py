@@ -0,0 +1,135 @@
+"""
+Index of the .SUBCKT and .MODEL definitions in SPICE model library files.
+
+Vendor libraries can hold thousands of definitions. Inlining a whole file
+into every deck makes ngspice parse all of them. A library file is parsed
+once (and again only when its mtime changes) into named entries. A deck
+then gets just the definitions it instantiates, plus whatever those
+reference in turn, plus the file's top level statements (.OPTION, .PARAM, ...).
+
+    library = load_library('BFR181_spice_v2.txt')
+    spice = library.emit(['BFR181'])
+"""
+
+import os
+import re
+import threading
+
+TOKEN = re.compile(r"[^\s=(),]+")
+
+
+class LibraryEntry(object):
+    def __init__(self, kind, name, text):
+        self.kind = kind # 'subckt' or 'model'
+        self.name = name
+        self.text = text
+        self.references = set() # Lowercased tokens that may name other entries
+
+
+class ModelLibrary(object):
+    def __init__(self, path):
+        self.path = path
+        self.entries = {} # Lowercased name -> LibraryEntry
+        self.statements = [] # Top level dot statements other than definitions
+        self.emitted = {}
+        self.parse()
+
+    def parse(self):
+        with open(self.path, 'r', errors='replace') as f:
+            lines = f.read().splitlines()
+
+        entry = None
+        depth = 0
+        body = []
+        for line in lines:
+            lowered = line.strip().lower()
+            if entry is not None and entry.kind == 'model':
+                # A .MODEL runs on through its continuation (and comment) lines
+                if not lowered or lowered.startswith(('+', '*')):
+                    body.append(line)
+                    continue
+                self._add(entry, body)
+                entry = None
+
+            if entry is None:
+                if lowered.startswith(('.subckt', '.model')):
+                    kind = 'subckt' if lowered.startswith('.subckt') else 'model'
+                    entry = LibraryEntry(kind, line.split()[1], None)
+                    depth = 1
+                    body = [line]
+                elif lowered.startswith('+') and self.statements:
+                    self.statements[-1] += "\n" + line
+                elif lowered.startswith('.') and not lowered.startswith('.end'):
+                    self.statements.append(line)
+                continue
+
+            body.append(line)
+            if not lowered or lowered.startswith('*'):
+                continue
+            if lowered.startswith('.subckt'):
+                depth += 1
+            elif lowered.startswith('.ends'):
+                depth -= 1
+                if depth == 0:
+                    self._add(entry, body)
+                    entry = None
+            else:
+                entry.references.update(token.lower() for token in TOKEN.findall(lowered.lstrip('+')))
+        if entry is not None:
+            if entry.kind != 'model':
+                raise Exception("Unterminated .SUBCKT in library", self.path, entry.name)
+            self._add(entry, body)
+
+    def _add(self, entry, body):
+        entry.text = "\n".join(body) + "\n"
+        entry.references.discard(entry.name.lower())
+        self.entries[entry.name.lower()] = entry
+
+    def __contains__(self, name):
+        return name.lower() in self.entries
+
+    def resolve(self, names):
+        """ names plus every entry they reference, directly or not, dependencies first """
+        order = []
+        seen = set()
+
+        def visit(name):
+            key = name.lower()
+            if key in seen:
+                return
+            seen.add(key)
+            entry = self.entries[key]
+            for reference in sorted(entry.references):
+                if reference in self.entries:
+                    visit(reference)
+            order.append(entry)
+
+        for name in names:
+            if name.lower() not in self.entries:
+                raise Exception("No .SUBCKT or .MODEL in library", self.path, name)
+            visit(name)
+        return order
+
+    def emit(self, names):
+        """ The text to inline for a deck that instantiates names """
+        key = tuple(sorted(name.lower() for name in names))
+        if key not in self.emitted:
+            statements = ''.join(statement + "\n" for statement in self.statements)
+            self.emitted[key] = statements + ''.join(entry.text for entry in self.resolve(names))
+        return self.emitted[key]
+
+
+# Parsed libraries, keyed by path and checked against mtime
+LIBRARIES = {}
+LIBRARIES_LOCK = threading.Lock()
+
+def load_library(path):
+    mtime = os.stat(path).st_mtime_ns
+    with LIBRARIES_LOCK:
+        cached = LIBRARIES.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    library = ModelLibrary(path)
+    with LIBRARIES_LOCK:
+        LIBRARIES[path] = (mtime, library)
+    return library
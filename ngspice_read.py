@@ -25,15 +25,33 @@
 # - Added search by name to get_datavector(self,n) to be able to retrieve
 #   by node name
 # - Added support for LTspice ASCII format and Offset keyword
+# - Binary data is read through mmap, vectors are zero-copy views into the file
 
 from __future__ import print_function
+import mmap
 import numpy
+import os
+import re
 import string
 import sys
+import tempfile
 
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
+## Placeholder for the raw file path in decks whose .control block writes
+## the raw file itself, replaced by whoever runs the deck
+RAW_FILE = "__RAW_FILE__"
+
+def scratch_dir():
+    """
+    Directory for transient raw files: tmpfs (/dev/shm) when there is one, so
+    raw data stays in memory, otherwise the regular temp directory.
+    """
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
 
 class spice_vector(object):
     """
@@ -172,6 +190,64 @@ class spice_plot(object):
         return self.data_vectors        
 
 
+class raw_buffer(object):
+    """
+    Minimal file-like cursor over bytes or an mmap, so that binary data can
+    be handed out as numpy views of the underlying buffer instead of copies.
+    """
+
+    def __init__(self, buf):
+        self.buf = buf
+        self.pos = 0
+
+    def readline(self):
+        end = self.buf.find(b"\n", self.pos)
+        end = len(self.buf) if end < 0 else end + 1
+        line = self.buf[self.pos:end]
+        self.pos = end
+        return line
+
+    def array(self, dtype, count):
+        """
+        returns the next count items as a read-only numpy view of the buffer
+        """
+        a = numpy.frombuffer(self.buf, dtype=dtype, count=count, offset=self.pos)
+        self.pos += a.nbytes
+        return a
+
+    ## the next header line ("Title:", "Plotname:", ...) ends a values block
+    BLOCK_END = re.compile(rb"\n[A-Za-z]")
+    CHUNK = 1 << 24
+
+    def ascii_values(self, npoints, width):
+        """
+        Parses a whole "Values:" block with numpy instead of line by line.
+        Every point is an index followed by width numbers (re,im pairs count
+        as two), so the block is converted in big chunks as one whitespace
+        separated stream. Returns a (npoints, width) array, or None if the
+        block does not have that layout.
+        """
+        match = self.BLOCK_END.search(self.buf, self.pos)
+        end = len(self.buf) if match is None else match.start() + 1
+        out = numpy.empty(npoints*(width+1), dtype="float64")
+        n = 0
+        start = self.pos
+        while start < end:
+            stop = min(end, start + self.CHUNK)
+            if stop < end:
+                stop = self.buf.rfind(b"\n", start, stop) + 1 or end
+            values = numpy.fromstring(self.buf[start:stop].replace(b",", b" "), sep=" ")
+            if n + len(values) > len(out):
+                return None
+            out[n:n+len(values)] = values
+            n += len(values)
+            start = stop
+        if n != len(out):
+            return None
+        self.pos = end
+        return out.reshape(npoints, width+1)[:,1:]
+
+
 class ngspice_read(object):
     """
     This class is reads a spice data file and returns a list of spice_plot
@@ -181,9 +257,13 @@ class ngspice_read(object):
     ngspice-rework-17 file ./src/frontend/rawfile.c
     """
 
-    def __init__(self, filename):
+    def __init__(self, filename, use_mmap=True, bulk_ascii=True):
+        self.use_mmap = use_mmap
+        self.bulk_ascii = bulk_ascii
         self.plots = []
         self.set_default_values()
+        if filename is None: ## header parsing only, see iter_chunks()
+            return
         error = self.readfile(filename)
         if error:
             ## FIXME create an assertion
@@ -198,17 +278,53 @@ class ngspice_read(object):
         self.padded = True
         self.real = True
         self.vectors = []
+        self.t_offset = 0.0
+
+    @classmethod
+    def from_buffer(cls, buf, bulk_ascii=True):
+        """
+        Parses raw file contents that are already in memory (bytes, bytearray,
+        mmap or a memoryview of one), binary vectors are views of buf.
+        """
+        reader = cls(None, bulk_ascii=bulk_ascii)
+        reader.readbuffer(buf)
+        return reader
 
     def readfile(self,filename):
-        f = open(filename, "rb")
-        t_offset = 0.0
-        #with open(filename, "rb") as infile:
-        #ab = f.read()
-        #inf = ab.decode('ISO-8859-1')
+        with open(filename, "rb") as infile:
+            if self.use_mmap and infile.seek(0, 2) > 0:
+                ## views into the map keep it alive after the file is closed
+                ## (or even unlinked)
+                buf = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                infile.seek(0)
+                buf = infile.read()
+        return self.readbuffer(buf)
+
+    def readbuffer(self, buf):
+        if isinstance(buf, memoryview):
+            ## raw_buffer needs find(), which memoryviews lack
+            if buf.contiguous and buf.obj is not None and buf.nbytes == len(buf.obj):
+                buf = buf.obj
+            else:
+                buf = buf.tobytes()
+        f = raw_buffer(buf)
+        while (1):
+            keyword = self.read_header(f)
+            if keyword is None:   ## EOF
+                return
+            self.read_data(f, keyword)
+
+    def read_header(self, f):
+        """
+        Reads the header of the next plot from the file-like f, up to and
+        including its "Values:"/"Binary:" line. Returns that keyword, or
+        None at the end of the file.
+        """
         while (1):
             line = f.readline().decode('ISO-8859-1')
             if line == "":   ## EOF
-                return
+                return None
 
             tok = [t.strip() for t in line.split(":",1)]
             keyword = tok[0].lower()  ## don't care the case of the keyword entry
@@ -244,8 +360,8 @@ class ngspice_read(object):
                 # FIXME: How can I create such simulation files?
                 # numdims = string.atoi(tok[1])
             elif keyword == "offset":
-                t_offset = float(tok[1])
-                eprint('Recordings start at', t_offset, 's')
+                self.t_offset = float(tok[1])
+                eprint('Recordings start at', self.t_offset, 's')
             elif keyword == "command":
                 eprint('Warning: "command" option not implemented yet')
                 eprint('\t' + line)
@@ -271,57 +387,7 @@ class ngspice_read(object):
                         eprint("list of variables is to short")
 
             elif keyword in ["values","binary"]:
-                # read the data
-                if self.real:
-                    if keyword == "values":
-                        i = 0
-                        a = numpy.zeros(self.npoints*self.nvars, dtype="float64")
-                        while (i < self.npoints*self.nvars):
-                            t = str( f.readline().decode("utf-8") ).split('\t')
-                            if len(t) < 2:
-                                continue
-                            else:
-                                a[i] = float(t[-1])
-                            i += 1
-                    else: ## keyword = "binary"
-                        a = numpy.frombuffer(f.read(self.nvars*self.npoints*8),
-                                             dtype="float64")
-                                             
-                    aa = a.reshape(self.npoints,self.nvars)
-                    self.vectors[0].set_data(aa[:,0] + t_offset)
-                    self.current_plot.set_scalevector(self.vectors[0])
-                    for n in range(1,self.nvars):
-                        self.vectors[n].set_data(aa[:,n])
-                        self.current_plot.append_datavector(self.vectors[n])
-                        
-                else: # complex data
-                    if keyword == "values":
-                        i = 0
-                        a = numpy.zeros(self.npoints*self.nvars*2, dtype="float64")
-                        while (i < self.npoints*self.nvars*2):
-                            t = str( f.readline().decode("utf-8") ).split('\t')
-                            if len(t) < 2:  ## empty lines
-                                continue
-                            else:
-                                t = t[-1].split(",")
-                                a[i] = float(t[0])
-                                i += 1
-                                a[i] = float(t[1])
-                                i += 1
-                    else: ## keyword = "binary"
-                        a = numpy.frombuffer(f.read(self.nvars*self.npoints*8*2),
-                                             dtype="float64")
-                    aa = a.reshape(self.npoints, self.nvars*2)
-                    self.vectors[0].set_data(aa[:,0]) ## only the real part!
-                    self.current_plot.set_scalevector(self.vectors[0])
-                    for n in range(1,self.nvars):
-                        self.vectors[n].set_data(numpy.array(aa[:,2*n]+
-                                                             1j*aa[:,2*n+1]))
-                        self.current_plot.append_datavector(self.vectors[n])
-                        
-                # create new plot after the data
-                self.plots.append(self.current_plot)
-                self.set_default_values()
+                return keyword
 
             elif str.strip(keyword) == "": ## ignore empty lines
                 continue
@@ -331,10 +397,152 @@ class ngspice_read(object):
                       +line + '"\n')
                 #return 0
 
+    def read_data(self, f, keyword):
+        """
+        Reads the data block following a header into the current plot
+        """
+        t_offset = self.t_offset
+        if self.real:
+            a = None
+            if keyword == "values" and self.bulk_ascii:
+                a = f.ascii_values(self.npoints, self.nvars)
+            if keyword == "values" and a is None:
+                i = 0
+                a = numpy.zeros(self.npoints*self.nvars, dtype="float64")
+                while (i < self.npoints*self.nvars):
+                    t = str( f.readline().decode("utf-8") ).split('\t')
+                    if len(t) < 2:
+                        continue
+                    else:
+                        a[i] = float(t[-1])
+                    i += 1
+            elif keyword == "binary":
+                a = f.array("float64", self.nvars*self.npoints)
+                                     
+            ## columns are strided views, nothing is copied here
+            aa = a.reshape(self.npoints,self.nvars)
+            if t_offset:
+                self.vectors[0].set_data(aa[:,0] + t_offset)
+            else:
+                self.vectors[0].set_data(aa[:,0])
+            self.current_plot.set_scalevector(self.vectors[0])
+            for n in range(1,self.nvars):
+                self.vectors[n].set_data(aa[:,n])
+                self.current_plot.append_datavector(self.vectors[n])
+                
+        else: # complex data
+            a = None
+            if keyword == "values" and self.bulk_ascii:
+                a = f.ascii_values(self.npoints, self.nvars*2)
+            if keyword == "values" and a is None:
+                i = 0
+                a = numpy.zeros(self.npoints*self.nvars*2, dtype="float64")
+                while (i < self.npoints*self.nvars*2):
+                    t = str( f.readline().decode("utf-8") ).split('\t')
+                    if len(t) < 2:  ## empty lines
+                        continue
+                    else:
+                        t = t[-1].split(",")
+                        a[i] = float(t[0])
+                        i += 1
+                        a[i] = float(t[1])
+                        i += 1
+            elif keyword == "binary":
+                a = f.array("float64", self.nvars*self.npoints*2)
+            ## (re, im) pairs are laid out exactly like complex128
+            aa = a.view("complex128").reshape(self.npoints, self.nvars)
+            self.vectors[0].set_data(aa[:,0].real) ## only the real part!
+            self.current_plot.set_scalevector(self.vectors[0])
+            for n in range(1,self.nvars):
+                self.vectors[n].set_data(aa[:,n])
+                self.current_plot.append_datavector(self.vectors[n])
+                
+        # create new plot after the data
+        self.plots.append(self.current_plot)
+        self.set_default_values()
+
     def get_plots(self):
         return self.plots
 
 
+def iter_chunks(filename, rows=65536, vectors=None):
+    """
+    Streams a raw file instead of loading it. Yields (plot, scale, data) for
+    blocks of at most rows points of every plot in the file, where plot is
+    the spice_plot header (its vectors carry no data), scale holds the scale
+    vector values and data maps the names of the selected vectors (all if
+    vectors is None) to their values. Memory use is bounded by rows, not by
+    the length of the simulation.
+    """
+    reader = ngspice_read(None)
+    with open(filename, "rb") as f:
+        while (1):
+            keyword = reader.read_header(f)
+            if keyword is None:
+                return
+            plot = reader.current_plot
+            plot.set_scalevector(reader.vectors[0])
+            plot.set_datavectors(reader.vectors[1:])
+            selected = [n for n in range(1, reader.nvars)
+                        if vectors is None or reader.vectors[n].name in vectors]
+            width = reader.nvars if reader.real else reader.nvars*2
+
+            if keyword == "binary":
+                blocks = _binary_blocks(f, reader.npoints, width, rows)
+            else:
+                blocks = _ascii_blocks(f, reader.npoints, width, rows)
+            for block in blocks:
+                if not reader.real:
+                    block = block.view("complex128")
+                scale = block[:,0].real + reader.t_offset
+                yield plot, scale, {reader.vectors[n].name: block[:,n] for n in selected}
+
+            reader.set_default_values()
+
+
+def _binary_blocks(f, npoints, width, rows):
+    remaining = npoints
+    while remaining > 0:
+        n = min(rows, remaining)
+        block = numpy.frombuffer(f.read(n*width*8), dtype="float64")
+        n = len(block) // width
+        if n == 0: ## truncated file
+            return
+        yield block[:n*width].reshape(n, width)
+        remaining -= n
+
+
+## any line starting with a letter is the header of the next plot
+HEADER_LINE = re.compile(rb"^[A-Za-z]", re.M)
+
+def _ascii_blocks(f, npoints, width, rows):
+    per_point = width + 1 ## the index in front of every point
+    remaining = npoints
+    numbers = numpy.zeros(0)
+    pending = b""
+    done = False
+    while remaining > 0 and not done:
+        data = pending + f.read(raw_buffer.CHUNK)
+        match = HEADER_LINE.search(data)
+        if match is not None or len(data) == len(pending):
+            end = len(data) if match is None else match.start()
+            f.seek(end - len(data), 1) ## leave the next header for read_header
+            done = True
+        else:
+            end = data.rfind(b"\n") + 1
+        pending = data[end:]
+        values = numpy.fromstring(data[:end].replace(b",", b" "), sep=" ")
+        numbers = numpy.concatenate((numbers, values))
+
+        available = min(len(numbers) // per_point, remaining)
+        while available >= rows or (done and available > 0):
+            n = min(rows, available)
+            yield numbers[:n*per_point].reshape(n, per_point)[:,1:]
+            numbers = numbers[n*per_point:]
+            available -= n
+            remaining -= n
+
+
 if __name__ == "__main__":
     ## plot out some informations about the ngspice files given by commandline
     for f in sys.argv[1:]:
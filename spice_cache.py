@@ -0,0 +1,152 @@
+"""
+Content-addressed cache of parsed simulation results.
+
+Results are keyed on a hash of the complete deck handed to ngspice. The deck
+already inlines every imported model file (see Circuit.load_imports), so
+editing a model library changes the key just like editing the netlist does.
+
+    cache = SimulationCache(directory='.spice-cache')
+    c = Circuit(cache=cache)
+"""
+
+from collections import OrderedDict
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+
+
+def deck_key(spice):
+    return hashlib.sha256(spice.encode()).hexdigest()
+
+
+def result_size(result):
+    size = 0
+    for plot in result.get_plots():
+        for vec in [plot.get_scalevector()] + plot.get_datavectors():
+            size += vec.get_data().nbytes
+    return size
+
+
+class SimulationCache(object):
+    """
+    Two tier LRU: an in-memory dict of parsed results in front of an optional
+    directory of pickled ones. Both tiers are bounded in bytes.
+    """
+
+    def __init__(self, max_memory=256 * 2**20, directory=None, max_disk=4 * 2**30):
+        self.max_memory = max_memory
+        self.directory = directory
+        self.max_disk = max_disk
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        self.hits = self.memory_hits = self.disk_hits = self.misses = 0
+        self.lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self, spice):
+        key = deck_key(spice)
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                self.memory_hits += 1
+                return self.memory[key][0]
+
+        result = self._load(key)
+        with self.lock:
+            if result is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+            self._remember(key, result)
+        return result
+
+    def put(self, spice, result):
+        key = deck_key(spice)
+        with self.lock:
+            self._remember(key, result)
+        self._store(key, result)
+
+    def run(self, spice, simulate):
+        """ Returns the cached result for spice, otherwise simulate(spice) and caches it """
+        result = self.get(spice)
+        if result is None:
+            result = simulate(spice)
+            self.put(spice, result)
+        return result
+
+    def _remember(self, key, result):
+        size = result_size(result)
+        if size > self.max_memory:
+            return
+        if key in self.memory:
+            self.memory_size -= self.memory.pop(key)[1]
+        self.memory[key] = (result, size)
+        self.memory_size += size
+        while self.memory_size > self.max_memory:
+            _, (_, evicted) = self.memory.popitem(last=False)
+            self.memory_size -= evicted
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".pickle")
+
+    def _load(self, key):
+        if self.directory is None:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                result = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        os.utime(path) # mtime doubles as the LRU clock for the disk tier
+        return result
+
+    def _store(self, key, result):
+        if self.directory is None:
+            return
+        fd, scratch = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(scratch, self._path(key))
+        self._evict_disk()
+
+    def _evict_disk(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".pickle"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self.memory_size = 0
+        if self.directory is not None:
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".pickle"):
+                    os.remove(entry.path)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'memory_entries': len(self.memory),
+                'memory_bytes': self.memory_size,
+            }
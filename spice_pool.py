@@ -0,0 +1,205 @@
+"""
+A pool of long-lived ngspice processes driven in pipe mode (ngspice -p).
+
+Each worker keeps a single ngspice process alive and feeds it decks through
+its own scratch directory, so a simulation only pays for `source` + `run`
+instead of a full fork/exec and ngspice start-up.
+
+    pool = SpicePool(size=4)
+    c = Circuit(pool=pool)
+    c.compute_operating_point()
+"""
+
+from subprocess import Popen, PIPE, STDOUT
+from ngspice_read import ngspice_read, scratch_dir, RAW_FILE
+import itertools
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+
+
+class SpiceWorkerError(Exception):
+    pass
+
+
+class SpiceTimeout(SpiceWorkerError):
+    pass
+
+
+class SpiceWorker(object):
+    MARKER = itertools.count()
+
+    def __init__(self, command=('ngspice',)):
+        self.command = list(command)
+        self.scratch_dir = tempfile.mkdtemp(dir=scratch_dir())
+        self.deck_file = os.path.join(self.scratch_dir, "spice.cir")
+        self.raw_file = os.path.join(self.scratch_dir, "spice.raw")
+        self.process = None
+        self.jobs = 0
+        self.restarts = 0
+        self.start()
+
+    def start(self):
+        self.process = Popen(self.command + ['-p'], stdin=PIPE, stdout=PIPE, stderr=STDOUT,
+                             universal_newlines=True, bufsize=1)
+        self.lines = queue.Queue()
+        threading.Thread(target=self._pump, args=(self.process, self.lines), daemon=True).start()
+        self.last_used = time.monotonic()
+        self._command(["set filetype=binary", "set nomoremode", "set noaskquit"], timeout=30)
+
+    @staticmethod
+    def _pump(process, lines):
+        for line in process.stdout:
+            lines.put(line)
+        lines.put(None)
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def _command(self, commands, timeout=None):
+        """ Sends commands and blocks until ngspice has worked through all of them """
+        marker = F"turmeric-done-{next(SpiceWorker.MARKER)}"
+        output = []
+        try:
+            self.process.stdin.write(''.join(c + "\n" for c in commands + ["echo " + marker]))
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError):
+            raise SpiceWorkerError("ngspice worker is not running")
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                line = self.lines.get(timeout=None if deadline is None else max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                raise SpiceTimeout(F"ngspice did not finish within {timeout}s")
+            if line is None:
+                self.process.wait()
+                raise SpiceWorkerError("ngspice worker exited:\n" + ''.join(output[-20:]))
+            if line.strip().endswith(marker):
+                return ''.join(output)
+            output.append(line)
+
+    def ping(self, timeout=5):
+        if not self.alive():
+            return False
+        try:
+            self._command([], timeout=timeout)
+            return True
+        except SpiceWorkerError:
+            return False
+
+    def run(self, spice, timeout=None):
+        if RAW_FILE in spice:
+            # The .control block runs on source and writes the raw file itself
+            spice = spice.replace(RAW_FILE, self.raw_file)
+            commands = [F"source {self.deck_file}"]
+        else:
+            commands = [F"source {self.deck_file}", F"run {self.raw_file}"]
+        with open(self.deck_file, 'w') as f:
+            f.write(spice)
+        if os.path.exists(self.raw_file):
+            os.remove(self.raw_file)
+        self.jobs += 1
+        self.last_used = time.monotonic()
+        log = self._command(commands + ["remcirc", "destroy all"], timeout=timeout)
+        if not os.path.exists(self.raw_file):
+            raise SpiceWorkerError("ngspice produced no raw output:\n" + log)
+        try:
+            return ngspice_read(self.raw_file)
+        finally:
+            os.remove(self.raw_file)
+
+    def restart(self):
+        self.kill()
+        self.restarts += 1
+        self.start()
+
+    def kill(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+    def stop(self):
+        if self.alive():
+            try:
+                self.process.stdin.write("quit\n")
+                self.process.stdin.flush()
+                self.process.wait(timeout=5)
+            except Exception:
+                pass
+        self.kill()
+        shutil.rmtree(self.scratch_dir, ignore_errors=True)
+
+
+class SpicePool(object):
+    """ A fixed number of ngspice workers shared by any number of Circuits (and threads) """
+
+    def __init__(self, size=None, command=('ngspice',), timeout=60, retries=1, check_interval=30):
+        self.size = size or os.cpu_count() or 1
+        self.command = command
+        self.timeout = timeout
+        self.retries = retries
+        self.check_interval = check_interval
+        self.workers = [SpiceWorker(command) for i in range(self.size)]
+        self.idle = queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+
+    def run(self, spice, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        worker = self.idle.get()
+        try:
+            for attempt in itertools.count():
+                if not self._healthy(worker):
+                    worker.restart()
+                try:
+                    return worker.run(spice, timeout=timeout)
+                except SpiceTimeout:
+                    # A hung simulation leaves ngspice busy, so the process is unusable
+                    worker.restart()
+                    raise
+                except SpiceWorkerError:
+                    if worker.alive() or attempt >= self.retries:
+                        raise
+                    worker.restart()
+        finally:
+            self.idle.put(worker)
+
+    def _healthy(self, worker):
+        if not worker.alive():
+            return False
+        if time.monotonic() - worker.last_used > self.check_interval:
+            return worker.ping()
+        return True
+
+    def health_check(self):
+        """ Pings every idle worker and restarts the ones that do not answer, returns the restart count """
+        idle = []
+        while True:
+            try:
+                idle.append(self.idle.get_nowait())
+            except queue.Empty:
+                break
+        restarted = 0
+        try:
+            for worker in idle:
+                if not worker.ping():
+                    worker.restart()
+                    restarted += 1
+        finally:
+            for worker in idle:
+                self.idle.put(worker)
+        return restarted
+
+    def close(self):
+        for worker in self.workers:
+            worker.stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
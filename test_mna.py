@@ -0,0 +1,99 @@
+"""
+Checks of the native MNA engine against closed form answers and, when it is
+installed, against ngspice.
+
+    python -m pytest test_mna.py
+"""
+
+from main import Circuit, Resistor, Capacitor, Voltage, connect, ground
+import mna
+import numpy
+import pytest
+import shutil
+
+
+def divider(engine='native', top=1e3, bottom=3e3, voltage=1):
+    c = Circuit(engine=engine)
+    source = Voltage(c, voltage=voltage)
+    r1 = Resistor(c, resistance=top)
+    r2 = Resistor(c, resistance=bottom)
+    connect(source.pos, r1)
+    connect(r1, r2)
+    ground(source.neg, r2)
+    return c, source, r2
+
+
+def low_pass(engine='native', resistance=1e3, capacitance=1e-9, **source):
+    c = Circuit(engine=engine)
+    vin = Voltage(c, **source)
+    r = Resistor(c, resistance=resistance)
+    cap = Capacitor(c, capacitance=capacitance)
+    connect(vin.pos, r)
+    connect(r, cap)
+    ground(vin.neg, cap)
+    return c, vin, cap
+
+
+def test_divider_operating_point():
+    c, source, r2 = divider(voltage=2)
+    c.compute_operating_point()
+    assert numpy.isclose(c.operating_points[source.pos.node], 2)
+    assert numpy.isclose(c.operating_points[r2.ports[0].node], 1.5)
+
+
+def test_divider_dc_sweep():
+    c, source, r2 = divider()
+    c.compute_dc_sweep((source, 0, 2, 0.5))
+    assert numpy.allclose(c.operating_points[r2.ports[0].node], 0.75 * numpy.arange(0, 2.01, 0.5))
+
+
+def test_low_pass_ac():
+    c, vin, cap = low_pass(voltage=1, ac=True)
+    c.compute_ac_sweep(1, 1e8, 10)
+    frequencies = mna.ac_frequencies(1, 1e8, 10)
+    expected = 1 / (1 + 2j * numpy.pi * frequencies * 1e3 * 1e-9)
+    assert numpy.allclose(c.operating_points[cap.ports[0].node], expected, rtol=1e-12, atol=1e-12)
+
+
+def test_low_pass_ramp_transient():
+    # v = t / T into an RC: v_c(t) = (t - tau (1 - exp(-t / tau))) / T
+    tau, ramp = 1e-6, 1e-5
+    c, vin, cap = low_pass(resistance=1e3, capacitance=1e-9, piecewise=[0, 0, ramp, 1])
+    c.compute_transient(ramp, tau / 100)
+    t = numpy.linspace(0, ramp, 1001)
+    expected = (t - tau * (1 - numpy.exp(-t / tau))) / ramp
+    assert numpy.allclose(c.operating_points[cap.ports[0].node], expected, atol=1e-4)
+
+
+def test_initial_conditions_transient():
+    # warm_start='ic' holds the capacitor at 1 V, then it discharges into the 0 V source
+    c, vin, cap = low_pass(resistance=1e3, capacitance=1e-9, voltage=0)
+    c.warm_start = 'ic'
+    c.initial_guess = {cap.ports[0].node: 1.0}
+    c.compute_transient(5e-6, 1e-8)
+    t = numpy.linspace(0, 5e-6, 501)
+    assert numpy.allclose(c.operating_points[cap.ports[0].node], numpy.exp(-t / 1e-6), atol=1e-4)
+
+
+def test_native_parameter_sweep():
+    c, source, r2 = divider()
+    sweep = c.parameter_sweep({(r2, 'resistance'): [1e3, 3e3]}, 'op')
+    assert numpy.allclose(sweep.voltage(r2.ports[0]), [0.5, 0.75])
+    assert c.last_run_stats.engine == 'native'
+    assert r2.resistance == 3e3
+
+
+@pytest.mark.skipif(shutil.which('ngspice') is None, reason="ngspice is not installed")
+@pytest.mark.parametrize('analysis, args', [
+    ('op', ()),
+    ('ac', (1, 1e8, 10)),
+    ('tran', (1e-5, 1e-8)),
+])
+def test_against_ngspice(analysis, args):
+    if analysis == 'op':
+        c, source, r2 = divider(engine='ngspice')
+    else:
+        c, vin, cap = low_pass(engine='ngspice', voltage=1, ac=True, piecewise=[0, 0, 1e-5, 1] if analysis == 'tran' else None)
+    differences = mna.compare(c, analysis, *args)
+    assert differences
+    assert max(differences.values()) < 1e-3